@@ -0,0 +1,36 @@
+# Compares form field extraction with a BeautifulSoup tree against the
+# streaming extractor in htmlutils.
+#
+# Run from the repository root:
+#   python -m benchmarks.bench_htmlutils
+
+import timeit
+
+import bs4
+
+import htmlutils
+from benchmarks.fixtures import touch_frame_page
+
+def main():
+    html = touch_frame_page()
+    selector = 'form#frmTouchFrame'
+
+    def tree():
+        bs = bs4.BeautifulSoup(html, 'html.parser')
+        return htmlutils.parse_form_fields(bs.select_one(selector))
+
+    def stream():
+        return htmlutils.form_fields_from_selector(html, selector)
+
+    assert tree() == stream()
+
+    number = 10
+    tree_time = min(timeit.repeat(tree, number=number, repeat=3)) / number
+    stream_time = min(timeit.repeat(stream, number=number, repeat=3)) / number
+    print(f'Page size: {len(html) / 1024:.0f} KiB')
+    print(f'BeautifulSoup (html.parser): {tree_time * 1000:8.2f} ms')
+    print(f'Streaming extractor:         {stream_time * 1000:8.2f} ms')
+    print(f'Speedup:                     {tree_time / stream_time:8.1f}x')
+
+if __name__ == '__main__':
+    main()
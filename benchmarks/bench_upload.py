@@ -0,0 +1,99 @@
+# Uploads a synthetic month (or more) to a local mock server, to measure
+# the cost of set_day() in round trips and seconds without
+# touching a real accounting system.
+#
+# Run from the repository root:
+#   python -m benchmarks.bench_upload --system millnet --days 20 --jobs 4 --latency 0.05
+
+import argparse
+import contextlib
+import datetime
+import importlib
+import logging
+import os
+import sys
+import tempfile
+import time
+import types
+
+try:
+    import config
+except ImportError:
+    config = types.ModuleType('config')
+    sys.modules['config'] = config
+
+import report
+import timerec
+import uploadledger
+from benchmarks import mockservers, timerecdb
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--system', choices=sorted(mockservers.HANDLERS),
+                        default='xledger')
+    parser.add_argument('--days', type=int, default=20,
+                        help='Number of workdays to upload. Default: 20')
+    parser.add_argument('--entries-per-day', type=int, default=8)
+    parser.add_argument('--categories', type=int, default=10)
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds added to each request. Default: 0.05')
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if args.verbose:
+        # report sets up the logging
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    projects = [f'Project {i + 1:03}' for i in range(args.categories)]
+    server = mockservers.MockServer(mockservers.HANDLERS[args.system],
+                                    latency=args.latency, jitter=args.jitter,
+                                    error_rate=args.error_rate,
+                                    projects=projects, seed=0)
+    # The backends keep cookies and caches in the working directory. It is
+    # restored before the directory is removed.
+    with (server, tempfile.TemporaryDirectory() as tmp_dir,
+          contextlib.chdir(tmp_dir)):
+        db_filename = os.path.join(tmp_dir, 'timerec.db')
+        # Workdays only, so round up to whole weeks
+        timerecdb.generate(db_filename, (args.days + 4) // 5 * 7 / 365,
+                           args.entries_per_day, args.categories)
+
+        config.timerec_db_filename = db_filename
+        config.detect_lunch = True
+        config.min_lunch_duration = datetime.timedelta(minutes=30)
+        config.account_mapping = timerecdb.account_mapping(args.categories,
+                                                           args.system)
+        setattr(config, f'{args.system}_baseurl', server.url)
+        setattr(config, f'{args.system}_username', 'bench')
+        setattr(config, f'{args.system}_ask_password', lambda: 'bench')
+        config.xledger_pair_password = 'bench'
+
+        target = importlib.import_module(args.system)
+        begin_date = timerecdb.FIRST_DATE
+        end_date = begin_date + datetime.timedelta(days=(args.days + 4) // 5 * 7 - 1)
+        days = report.collect_days(timerec, target, begin_date, end_date,
+                                   args.system == 'flexhrm')[:args.days]
+
+        report_args = argparse.Namespace(dry_run=False, jobs=args.jobs)
+        start = time.perf_counter()
+        error = None
+        with uploadledger.Ledger() as ledger:
+            try:
+                report.upload_report(report_args, target, days, ledger)
+            except Exception as e:
+                # Expected with --error-rate
+                error = e
+        elapsed = time.perf_counter() - start
+
+    print(f'{len(days)} days to {args.system} in {elapsed:.2f} s '
+          f'({elapsed / len(days) * 1000:.0f} ms/day), '
+          f'{sum(server.request_count.values())} requests, '
+          f'{len(server.saved)} saved values')
+    if error:
+        print(f'Upload failed: {error}')
+
+if __name__ == '__main__':
+    main()
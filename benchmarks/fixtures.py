@@ -0,0 +1,76 @@
+# Canned pages shaped like the ones the backends parse. Only the parts
+# that the parsers look at are realistic; the rest is filler of a similar
+# size.
+
+import json
+import uuid
+
+def _page(body, filler):
+    return ''.join(['<html><head><meta charset="utf-8">',
+                    '<script>var s = "<input name=x>";</script></head><body>',
+                    body,
+                    '<p>filler</p>' * filler,
+                    '</body></html>']).encode()
+
+def touch_frame_page(fields=300, filler=2000):
+    '''A page shaped like Xledger's TouchFrame.aspx: a large ASP.NET form
+    with hidden fields, surrounded by other markup.'''
+    parts = ['<form method="post" id="frmTouchFrame">',
+             '<input type="hidden" name="__EVENTVALIDATION" value="',
+             'A' * 20000, '" />',
+             '<input type="hidden" name="__PBT75108-2329-3" value="7" />']
+    for i in range(fields):
+        parts.append(f'<div class="row"><span>Label {i}</span>'
+                     f'<input type="text" name="fb$ctl00$f{i}" value="{i}" />'
+                     f'<select name="fb$ctl00$s{i}"><option value="a">A</option>'
+                     f'<option value="b">B</option></select></div>')
+    parts.append('<textarea name="fb$ctl00$txtSText"></textarea></form>')
+    return _page(''.join(parts), filler)
+
+def flexhrm_row(row_id=None, columns=6):
+    '''One time row, like FlexHRM's new row response.'''
+    row_id = row_id or str(uuid.uuid4())
+    prefix = f'Tidrapportdag.Tidrader[{row_id}]'
+    extraparams = json.dumps({ 'kodtyp': '1', 'datum': '2021-04-01' })
+    parts = ['<div class="row">',
+             f'<input type="hidden" name="Tidrapportdag.Tidrader.Index" value="{row_id}" />',
+             f'<input type="text" name="{prefix}.FromKlockslag.Value" value="" />',
+             f'<input type="text" name="{prefix}.TomKlockslag.Value" value="" />',
+             f'<input type="text" name="{prefix}.Tidkod.Value.EntityDescription" '
+             f'data-extraparams="{extraparams.replace(chr(34), "&quot;")}" value="" />',
+             f'<input type="hidden" name="{prefix}.Tidkod.Value.Id" value="" />']
+    for col in range(columns):
+        col_id = str(uuid.UUID(int=col))
+        col_prefix = f'{prefix}.Konteringar[{col_id}]'
+        parts += [f'<input type="hidden" name="{prefix}.Konteringar.Index" value="{col_id}" />',
+                  f'<input type="text" name="{col_prefix}.Value.EntityDescription" value="" />',
+                  f'<input type="hidden" name="{col_prefix}.Value.Id" value="" />',
+                  f'<input type="hidden" name="{col_prefix}.Value.ForetagKonteringsdimensionId" '
+                  f'value="{uuid.UUID(int=100 + col)}" />']
+    parts.append(f'<textarea name="{prefix}.Kommentar"></textarea></div>')
+    return ''.join(parts)
+
+def flexhrm_day_page(rows=8, filler=1000):
+    '''A page shaped like FlexHRM's Dagredovisning, with existing rows.'''
+    parts = ['<form id="edit" method="post" lock-action="/HRM/Tid/Dagredovisning/Lock">',
+             '<input type="hidden" name="__RequestVerificationToken" value="token" />',
+             '<input type="hidden" id="Tidgrupp_Id" name="Tidgrupp.Id" value="42" />',
+             '<input type="hidden" name="ModelDirty" value="" />']
+    parts += [flexhrm_row(str(uuid.UUID(int=1000 + i))) for i in range(rows)]
+    parts.append('</form>')
+    return _page(''.join(parts), filler)
+
+def millnet_main_page(rows=40, filler=1000):
+    '''A page shaped like Millnet's week view, with existing rows.'''
+    parts = ['<form id="mt_main_form" name="mt_main_form" method="post">',
+             '<input type="hidden" name="periodtype" value="W" />',
+             '<input type="hidden" name="date" value="2021-04-05" />']
+    for i in range(rows):
+        parts += [f'<input type="hidden" name="ro_{i}" value="{i + 2}.000000" />',
+                  f'<input type="hidden" name="pid_{i}" value="P{i % 10}" />',
+                  f'<input type="hidden" name="aid_{i}" value="A{i % 3}" />',
+                  f'<input type="hidden" name="regday_{i}" value="2021040{5 + i % 5}" />',
+                  f'<input type="text" name="rt_{i}" value="1.5" />',
+                  f'<select name="pha_{i}"><option value="Default">Default</option></select>']
+    parts.append('</form>')
+    return _page(''.join(parts), filler)
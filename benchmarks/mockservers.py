@@ -0,0 +1,464 @@
+# Local stand-ins for Xledger, FlexHRM and Millnet, implementing the
+# endpoints that the backends use for logging in, listing accounts and
+# uploading hours. Each server can add latency and fail a share of the
+# requests, to get realistic round-trip costs when benchmarking uploads
+# offline.
+#
+# Run from the repository root, and point the *_baseurl settings in
+# config.py at the printed URLs:
+#   python -m benchmarks.mockservers --latency 0.05 --error-rate 0.01
+
+import argparse
+import collections
+import datetime
+import html
+import json
+import random
+import threading
+import time
+import urllib.parse
+import uuid
+import http.cookies
+import http.server
+
+from benchmarks import fixtures
+
+DEFAULT_PROJECTS = [f'Project {i + 1:03}' for i in range(20)]
+DEFAULT_ACTIVITIES = ['Activity', 'Meeting', 'Travel']
+FLEXHRM_TIME_CODES = ['Normal', 'Lunch', 'Semester', 'Sjuk', 'Vab']
+FLEXHRM_COMPANIES = ['Company A', 'Company B']
+
+class MockServer(http.server.ThreadingHTTPServer):
+    '''
+    Serves one of the handlers below on localhost, by default on a free
+    port. Each request is delayed by latency plus up to jitter seconds,
+    and error_rate of them get error_status instead of a response.
+
+    Unless require_login is set, the client is always treated as logged
+    in. Otherwise, it is sent to the login page until it logs in, and
+    again after expire_logins().
+    '''
+    daemon_threads = True
+
+    def __init__(self, handler_class, port=0, latency=0, jitter=0,
+                 error_rate=0, error_status=503, projects=DEFAULT_PROJECTS,
+                 activities=DEFAULT_ACTIVITIES, seed=None, require_login=False):
+        super().__init__(('127.0.0.1', port), handler_class)
+        self.require_login = require_login
+        # Session cookie values of logged in clients
+        self.logins = set()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.projects = list(projects)
+        self.activities = list(activities)
+        self.random = random.Random(seed)
+        # Server state is shared by the handler threads
+        self.lock = threading.Lock()
+        # Uploaded hours, see each handler
+        self.saved = {}
+        self.request_count = collections.Counter()
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def expire_logins(self):
+        with self.lock:
+            self.logins.clear()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Set by each handler. Paths that can be used without logging in.
+    LOGIN_PAGE = None
+    PUBLIC_PATHS = ()
+    SESSION_COOKIE = 'MockSession'
+
+    # Keep-alive, like the real servers
+    protocol_version = 'HTTP/1.1'
+    # Don't let delayed ACKs add to the latency
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        self.query = { key: values[0] for key, values
+                       in urllib.parse.parse_qs(url.query, keep_blank_values=True).items() }
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode() if length else ''
+        # Repeated names become lists, like htmlutils.add_form_field()
+        self.form = {}
+        for name, value in urllib.parse.parse_qsl(body, keep_blank_values=True):
+            prev_value = self.form.get(name)
+            if prev_value is None:
+                self.form[name] = value
+            elif isinstance(prev_value, list):
+                prev_value.append(value)
+            else:
+                self.form[name] = [prev_value, value]
+
+        server = self.server
+        with server.lock:
+            server.request_count[(method, url.path)] += 1
+            delay = server.latency + server.random.uniform(0, server.jitter)
+            fail = server.random.random() < server.error_rate
+        time.sleep(delay)
+        if fail:
+            self.send_text(server.error_status, 'Injected error')
+            return
+        if (server.require_login and url.path not in self.PUBLIC_PATHS and
+            not self.logged_in()):
+            self.redirect(self.LOGIN_PAGE)
+            return
+        try:
+            self.route(method, url.path)
+        except Exception as e:
+            self.send_text(500, repr(e))
+
+    def route(self, method, path):
+        raise NotImplementedError()
+
+    def logged_in(self):
+        cookies = http.cookies.SimpleCookie(self.headers.get('Cookie', ''))
+        cookie = cookies.get(self.SESSION_COOKIE)
+        with self.server.lock:
+            return cookie is not None and cookie.value in self.server.logins
+
+    def log_in(self):
+        '''Returns the header that sets the session cookie.'''
+        value = uuid.uuid4().hex
+        with self.server.lock:
+            self.server.logins.add(value)
+        return { 'Set-Cookie': f'{self.SESSION_COOKIE}={value}; Path=/' }
+
+    def send_body(self, status, body, content_type, headers=None):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_text(self, status, text):
+        self.send_body(status, text, 'text/plain')
+
+    def send_html(self, body, headers=None):
+        self.send_body(200, body, 'text/html; charset=utf-8', headers)
+
+    def send_json(self, obj, headers=None):
+        self.send_body(200, json.dumps(obj), 'application/json', headers)
+
+    def redirect(self, location, headers=None):
+        self.send_body(302, '', 'text/plain', { 'Location': location,
+                                                **(headers or {}) })
+
+    def not_found(self):
+        self.send_text(404, f'Not found: {self.path}')
+
+def project_id(index):
+    return str(1000 + index)
+
+def activity_id(project_index, activity_index):
+    return str(100000 + project_index * 100 + activity_index)
+
+# Xledger
+
+class XledgerHandler(_Handler):
+    '''
+    saved: (date, project ID, activity ID) -> hours, from the last save
+    '''
+    PBT_FIELD = '__PBT75108-2329-3'
+    LOGIN_PAGE = '/Default.aspx'
+    PUBLIC_PATHS = ('/', '/Default.aspx')
+
+    def route(self, method, path):
+        if path in self.PUBLIC_PATHS:
+            if 'ucLogin$btnLoginDevice' in self.form:
+                self.send_body(302, '', 'text/plain',
+                               { 'Location': '/Restricted/Index.aspx', **self.log_in() })
+            else:
+                self.send_html('<html><body><form id="Default" method="post">'
+                               '<input type="hidden" name="__EVENTVALIDATION" value="ev" />'
+                               '</form></body></html>')
+        elif path == '/Restricted/Index.aspx':
+            self.send_html('<html><body>Index</body></html>')
+        elif path == '/Restricted/Touch.aspx':
+            self.send_html('<html><body>Touch</body></html>')
+        elif path == '/Restricted/TouchFrame.aspx':
+            if method == 'GET':
+                self.send_frame(counter=1)
+            else:
+                self.post_frame()
+        elif path == '/Restricted/Frame.aspx':
+            self.send_field_help()
+        else:
+            self.not_found()
+
+    def post_frame(self):
+        counter = int(self.form.get(self.PBT_FIELD, 0)) + 1
+        if 'fb$ctl00$pnlButtons$T' not in self.form:
+            # Project selected
+            self.send_frame(counter)
+            return
+        key = (self.form['fb$ctl00$txdDAssignment'],
+               self.form['fb$ctl00$ilsRvProject$ilsRvProject_fhp_Txt_PK'],
+               self.form['fb$ctl00$ilsRvActivity$ilsRvActivity_fhp_Txt_PK'])
+        hours = float(self.form['fb$ctl00$txfFWorkingHours'].replace(',', '.'))
+        with self.server.lock:
+            self.server.saved[key] = hours
+        # A new, empty entry form on the same page
+        self.send_frame(counter, saved=True)
+
+    def send_frame(self, counter, saved=False):
+        # Only the first 15 arguments are used
+        help_args = ', '.join(str(i) for i in range(2, 16))
+        page = fixtures.touch_frame_page(fields=50, filler=200).decode()
+        page = page.replace('name="__PBT75108-2329-3" value="7"',
+                            f'name="{self.PBT_FIELD}" value="{counter}"')
+        script = ('<script>'
+                  f"OpenFieldHelp(3, 'fb_ctl00_ilsRvProject_ilsRvProject_fhp_Txt', {help_args});"
+                  f"OpenFieldHelp(3, 'fb_ctl00_ilsRvActivity_ilsRvActivity_fhp_Txt', {help_args});"
+                  '</script>')
+        if saved:
+            script += '<a id="ReturnButtonZoom"></a>'
+        self.send_html(page.replace('</body>', script + '</body>'))
+
+    def send_field_help(self):
+        if 'Project' in self.query.get('sn', ''):
+            field = 'fb_ctl00_ilsRvProject_ilsRvProject_fhp_Txt'
+            items = [(project_id(i), name)
+                     for i, name in enumerate(self.server.projects)]
+        else:
+            field = 'fb_ctl00_ilsRvActivity_ilsRvActivity_fhp_Txt'
+            project_index = int(self.query['fk']) - 1000
+            items = [(activity_id(project_index, i), name)
+                     for i, name in enumerate(self.server.activities)]
+        rows = [f'<tr><td onclick="GetTop().ReturnFieldHelp(3, 4, &#39;{field}&#39;, '
+                f'{item_id}, &#39;{html.escape(name)}&#39;, true, false);">'
+                f'{html.escape(name)}</td></tr>'
+                for item_id, name in items]
+        self.send_html(f'<html><body><table>{"".join(rows)}</table></body></html>')
+
+# Millnet
+
+class MillnetHandler(_Handler):
+    '''
+    saved: (YYYYMMDD, project ID, activity ID) -> hours
+    '''
+    LOGIN_PAGE = '/cgi/login'
+    PUBLIC_PATHS = ('/cgi/login', '/cgi/mt.cgi/api/login')
+
+    def route(self, method, path):
+        if path == '/cgi/login':
+            self.send_html('<html><body>Log in</body></html>')
+        elif path == '/cgi/mt.cgi/api/login':
+            self.send_json({ 'success': True }, headers=self.log_in())
+        elif path == '/cgi/milltime.cgi':
+            self.send_html('<html><body>Milltime</body></html>')
+        elif path == '/cgi/milltime.cgi/mt_data':
+            params = self.query if method == 'GET' else self.form
+            if params.get('param1') == 'mt-get-projects':
+                self.send_projects(params)
+            elif params.get('param1') == 'mt-get-activities':
+                self.send_activities(params)
+            else:
+                self.not_found()
+        elif path == '/cgi/milltime.cgi/main' and method == 'POST':
+            if self.form.get('part') == 'save-time':
+                self.save_time()
+            self.send_main()
+        else:
+            self.not_found()
+
+    def send_projects(self, params):
+        projects = [{ 'id': project_id(i),
+                      'value': name,
+                      'leader': 'Leader',
+                      'groupname': 'Medlem',
+                      'group': '1',
+                      'customer': 'Customer',
+                      'projectnr': f'P{i:03}',
+                      'disabled': '0' }
+                    for i, name in enumerate(self.server.projects)]
+        start = int(params.get('start', 0))
+        limit = int(params.get('limit', len(projects)))
+        self.send_json({ 'success': True,
+                         'total': len(projects),
+                         'rows': projects[start:start + limit] })
+
+    def send_activities(self, params):
+        project_index = int(params['project_id']) - 1000
+        self.send_json({ 'rows': [{ 'PhaseName': '',
+                                    'Name': name,
+                                    'ActivityName': name,
+                                    'ActivityId': activity_id(project_index, i),
+                                    'PhaseId': 'Default',
+                                    'RequireNote': '0',
+                                    'CompleteName': name }
+                                  for i, name in enumerate(self.server.activities)] })
+
+    def save_time(self):
+        with self.server.lock:
+            index = 0
+            while f'pid_{index}' in self.form:
+                key = (self.form[f'regday_{index}'], self.form[f'pid_{index}'],
+                       self.form[f'aid_{index}'])
+                self.server.saved[key] = float(self.form[f'rt_{index}'])
+                index += 1
+
+    def send_main(self):
+        regday = self.form.get('date_begin') or self.form['period']
+        with self.server.lock:
+            rows = [(key, hours) for key, hours in sorted(self.server.saved.items())
+                    if key[0] == regday]
+        parts = ['<html><body><form id="mt_main_form" method="post">']
+        for i, ((regday, pid, aid), hours) in enumerate(rows):
+            parts += [f'<input type="hidden" name="ro_{i}" value="{i + 2}.000000" />',
+                      f'<input type="hidden" name="pid_{i}" value="{pid}" />',
+                      f'<input type="hidden" name="aid_{i}" value="{aid}" />',
+                      f'<input type="hidden" name="regday_{i}" value="{regday}" />',
+                      f'<input type="text" name="rt_{i}" value="{hours}" />']
+        parts.append('</form></body></html>')
+        self.send_html(''.join(parts))
+
+# FlexHRM
+
+class FlexHRMHandler(_Handler):
+    '''
+    saved: (YYYY-MM-DD, from, to) -> (time code ID, project ID)
+    '''
+    COMPANY_ID = '1'
+    EMPLOYEE_ID = '7'
+    DAY_PATH = '/HRM/Tid/Dagredovisning'
+    LOGIN_PAGE = '/HRM/Login'
+    PUBLIC_PATHS = ('/HRM/Login', '/HRM/Login/GetReqeustToken', '/HRM/Login/LogOn')
+
+    def route(self, method, path):
+        token = { 'AntiforgeryToken': uuid.uuid4().hex }
+        if path == '/HRM/Login':
+            self.send_html('<html><body><input type="hidden" id="Kundinstans" '
+                           'value="customer" /></body></html>')
+        elif path == '/HRM/Login/LogOn':
+            self.send_json({ 'RedirectUrl': '%2fHRM%2fdefault.aspx' },
+                           headers={ **token, **self.log_in() })
+        elif path == '/HRM/default.aspx':
+            self.redirect(f'/HRM/Home?f={self.COMPANY_ID}')
+        elif path in ('/HRM/AnvandarloggLogger/AddOrUpdatePost',
+                      '/HRM/PaminnelserWidget/GetPerForetag'):
+            self.send_json({})
+        elif path == '/HRM/':
+            self.redirect(f'/HRM/Home?f={self.COMPANY_ID}')
+        elif path == '/HRM/Home':
+            self.send_html('<html><body><input type="hidden" id="MyCalendarAnstallningId" '
+                           f'value="{self.EMPLOYEE_ID}" /></body></html>')
+        elif path in ('/HRM/RequestToken/GetReqeustToken',
+                      '/HRM/Login/GetReqeustToken'):
+            self.send_json({ 'Token': uuid.uuid4().hex })
+        elif path == self.DAY_PATH:
+            self.send_html(fixtures.flexhrm_day_page(rows=1, filler=200))
+        elif path == f'{self.DAY_PATH}/EmptyBodyRow':
+            self.send_html(f'<html><body>{fixtures.flexhrm_row()}</body></html>')
+        elif path == f'{self.DAY_PATH}/Lock':
+            self.send_json({}, headers=token)
+        elif path == f'{self.DAY_PATH}/Save':
+            self.save()
+            self.redirect(f'{self.DAY_PATH}?f={self.COMPANY_ID}', headers=token)
+        elif path == '/HRM/Tid/TidredovisningTidkod/AutoComplete':
+            self.send_matches(FLEXHRM_TIME_CODES, 'timecode')
+        elif path.startswith('/HRM/Kontering/') and path.endswith('/AutoCompleteProjektByDeltagare'):
+            self.send_matches(self.server.projects, 'project')
+        elif path.startswith('/HRM/Kontering/') and path.endswith('/AutoComplete'):
+            self.send_matches(FLEXHRM_COMPANIES, 'company')
+        else:
+            self.not_found()
+
+    def send_matches(self, names, kind):
+        term = self.form.get('term', '').lower()
+        self.send_json([{ 'label': name, 'id': f'{kind}-{i}' }
+                        for i, name in enumerate(names) if term in name.lower()])
+
+    def save(self):
+        # The date is URL encoded twice
+        us_date = urllib.parse.unquote(self.query['datum']).split(' ')[0]
+        date = datetime.datetime.strptime(us_date, '%m/%d/%Y').date().isoformat()
+        row_ids = self.form.get('Tidrapportdag.Tidrader.Index', [])
+        if not isinstance(row_ids, list):
+            row_ids = [row_ids]
+        with self.server.lock:
+            for row_id in row_ids:
+                prefix = f'Tidrapportdag.Tidrader[{row_id}]'
+                if self.form.get(f'{prefix}.NewRow') != 'True':
+                    continue
+                project = ''
+                for col_id in self.form.get(f'{prefix}.Konteringar.Index', []):
+                    if self.form.get(f'{prefix}.Konteringar[{col_id}].Changed') == 'True':
+                        project = self.form.get(f'{prefix}.Konteringar[{col_id}].Value.Id', '')
+                key = (date, self.form[f'{prefix}.FromKlockslag.Value'],
+                       self.form[f'{prefix}.TomKlockslag.Value'])
+                self.server.saved[key] = (self.form[f'{prefix}.Tidkod.Value.Id'], project)
+
+HANDLERS = { 'xledger': XledgerHandler,
+             'flexhrm': FlexHRMHandler,
+             'millnet': MillnetHandler }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds added to each request. Default: 0.05')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='Up to this many seconds are added at random')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Share of the requests that fail, e.g. 0.01')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--require-login', action='store_true',
+                        help='Send clients to the login page until they log in')
+    parser.add_argument('--port', type=int, default=8100,
+                        help='Port of the first server. Default: 8100')
+    args = parser.parse_args()
+
+    servers = []
+    for i, (name, handler_class) in enumerate(HANDLERS.items()):
+        server = MockServer(handler_class, port=args.port + i,
+                            latency=args.latency, jitter=args.jitter,
+                            error_rate=args.error_rate,
+                            error_status=args.error_status,
+                            require_login=args.require_login).start()
+        servers.append(server)
+        print(f'{name}_baseurl = {server.url!r}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    for server in servers:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# Measures the hot paths on a synthetic Time Recording database and canned
+# pages. Reports the best time of a few runs, the throughput and the peak
+# memory allocated by Python (measured in a separate run, with tracemalloc).
+#
+# Run from the repository root:
+#   python -m benchmarks.run --years 2 --entries-per-day 8
+
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+# The benchmarks set what they need, so a personal config is not required
+try:
+    import config
+except ImportError:
+    config = types.ModuleType('config')
+    sys.modules['config'] = config
+
+import bs4
+
+import htmlutils
+import report
+import timerec
+import timereporting
+from benchmarks import fixtures, timerecdb
+
+TARGET = 'xledger'
+
+def measure(func, repeat):
+    '''Returns (best time, item count, peak bytes). func returns the number
+    of items it processed.'''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, items, peak
+
+def timerec_benchmarks(begin_date, end_date):
+    def get_range():
+        with timerec.Session() as source:
+            return sum(len(entries) for _, entries in source.get_range(begin_date, end_date))
+
+    def get_day():
+        # One day at a time, like the reports did before get_range()
+        days = 0
+        with timerec.Session() as source:
+            date = begin_date
+            while date <= end_date:
+                source.get_day(date)
+                date += datetime.timedelta(days=1)
+                days += 1
+        return days
+
+    target = types.SimpleNamespace(name=TARGET)
+    def collect_days():
+        days = report.collect_days(timerec, target, begin_date, end_date, True)
+        return sum(len(entries) for _, entries in days)
+
+    with timerec.Session() as source:
+        all_entries = [entries for _, entries in source.get_range(begin_date, end_date)]
+    for entries in all_entries:
+        for entry in entries:
+            report.convert_entry(entry, timerec.name, TARGET)
+    def sum_entries():
+        for entries in all_entries:
+            timereporting.sum_entries(entries, TARGET)
+        return sum(len(entries) for entries in all_entries)
+
+    return [('timerec get_range', 'entries', get_range),
+            ('timerec get_day', 'days', get_day),
+            ('collect_days', 'entries', collect_days),
+            ('sum_entries', 'entries', sum_entries)]
+
+def html_benchmarks():
+    pages = [('xledger', fixtures.touch_frame_page(), 'form#frmTouchFrame'),
+             ('flexhrm', fixtures.flexhrm_day_page(), 'form#edit'),
+             ('millnet', fixtures.millnet_main_page(), 'form#mt_main_form')]
+    benchmarks = []
+    for name, html, selector in pages:
+        def parse_form_fields(html=html, selector=selector):
+            bs = bs4.BeautifulSoup(html, 'html.parser')
+            return len(htmlutils.parse_form_fields(bs.select_one(selector)))
+
+        def form_fields_from_selector(html=html, selector=selector):
+            return len(htmlutils.form_fields_from_selector(html, selector))
+
+        benchmarks += [(f'{name} parse_form_fields', 'fields', parse_form_fields),
+                       (f'{name} form_fields_from_selector', 'fields',
+                        form_fields_from_selector)]
+    return benchmarks
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--years', type=float, default=1)
+    parser.add_argument('--entries-per-day', type=int, default=8)
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of timed runs. The best is reported')
+    parser.add_argument('--db',
+                        help='Database file to (re)generate. Default: a temporary file')
+    parser.add_argument('-k', '--filter', default='',
+                        help='Only run benchmarks whose names contain this')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_filename = args.db or os.path.join(tmp_dir, 'timerec.db')
+        count = timerecdb.generate(db_filename, args.years, args.entries_per_day,
+                                   args.categories)
+        print(f'{count} entries, {args.years} years, {args.entries_per_day} entries/day, '
+              f'{args.categories} categories')
+
+        config.timerec_db_filename = db_filename
+        config.detect_lunch = True
+        config.min_lunch_duration = datetime.timedelta(minutes=30)
+        config.account_mapping = timerecdb.account_mapping(args.categories, TARGET)
+
+        begin_date = timerecdb.FIRST_DATE
+        end_date = begin_date + datetime.timedelta(days=round(args.years * 365) - 1)
+        benchmarks = timerec_benchmarks(begin_date, end_date) + html_benchmarks()
+
+        print(f'{"Benchmark":42} {"Items":>8} {"Best s":>8} {"Items/s":>10} {"Peak MiB":>8}')
+        for name, unit, func in benchmarks:
+            if args.filter not in name:
+                continue
+            best, items, peak = measure(func, args.repeat)
+            print(f'{name:42} {items:8} {best:8.3f} {items / best:10.0f} '
+                  f'{peak / 1024 / 1024:8.1f}  ({unit})')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# Writes a synthetic Time Recording database, with the tables and columns
+# that timerec.py and summary.py read.
+#
+# Run from the repository root:
+#   python -m benchmarks.timerecdb --years 5 --entries-per-day 8 bench.db
+
+import argparse
+import datetime
+import random
+import sqlite3
+
+import timerec
+
+FIRST_DATE = datetime.date(2020, 1, 1)
+CUSTOMERS_PER_CATEGORIES = 4
+
+def category_account(category_id):
+    '''The timerec account, (customer, category), of a generated category.'''
+    return (f'Customer {category_id // CUSTOMERS_PER_CATEGORIES + 1}',
+            f'Category {category_id + 1}')
+
+def workdays(years):
+    date = FIRST_DATE
+    end = FIRST_DATE + datetime.timedelta(days=round(years * 365))
+    while date < end:
+        if date.weekday() < 5:
+            yield date
+        date += datetime.timedelta(days=1)
+
+def day_entries(rnd, entries_per_day, categories):
+    '''
+    Returns (begin, end, category ID) in seconds since midnight. The
+    morning ends at 11:30 and the afternoon starts at 12:00, leaving room
+    for lunch.
+    '''
+    morning = max(1, entries_per_day // 2)
+    afternoon = max(1, entries_per_day - morning)
+    entries = []
+    for begin, end, count in ((8 * 3600, 11 * 3600 + 1800, morning),
+                              (12 * 3600, 17 * 3600, afternoon)):
+        # Split the block at random minutes
+        cuts = sorted(rnd.sample(range(begin // 60 + 1, end // 60), count - 1))
+        bounds = [begin] + [cut * 60 for cut in cuts] + [end]
+        for entry_begin, entry_end in zip(bounds, bounds[1:]):
+            entries.append((entry_begin, entry_end, rnd.randrange(categories)))
+    return entries
+
+def stamp(date, seconds):
+    return (datetime.datetime.combine(date, datetime.time())
+            + datetime.timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S')
+
+def generate(filename, years=1, entries_per_day=8, categories=20, seed=0):
+    '''
+    Writes the database. Returns the number of entries, i.e. pairs of
+    check-in and check-out stamps.
+    '''
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(filename)
+    try:
+        c = conn.cursor()
+        c.execute('drop table if exists T_STAMP_3')
+        c.execute('drop table if exists T_CATEGORY_1')
+        c.execute('create table T_CATEGORY_1 (id integer primary key, name text)')
+        c.execute('create table T_STAMP_3 (_id integer primary key, asofdate text, '
+                  'stamp_date_str text, check_action integer, customer text, '
+                  'category_id integer, comment text)')
+        c.executemany('insert into T_CATEGORY_1 (id, name) values (?, ?)',
+                      ((i, category_account(i)[1]) for i in range(categories)))
+
+        count = 0
+        rows = []
+        for date in workdays(years):
+            asofdate = date.strftime('%Y-%m-%d 00:00:00')
+            for begin, end, category_id in day_entries(rnd, entries_per_day,
+                                                       categories):
+                customer = category_account(category_id)[0]
+                comment = f'Ticket {rnd.randrange(10000)}' if rnd.random() < 0.2 else None
+                rows.append((asofdate, stamp(date, begin), timerec.CHECK_ACTION_IN,
+                             customer, category_id, comment))
+                rows.append((asofdate, stamp(date, end), timerec.CHECK_ACTION_OUT,
+                             customer, category_id, None))
+                count += 1
+        # Time Recording stores the stamps in the order they were made
+        c.executemany('insert into T_STAMP_3 (asofdate, stamp_date_str, check_action, '
+                      'customer, category_id, comment) values (?, ?, ?, ?, ?, ?)', rows)
+        conn.commit()
+    finally:
+        conn.close()
+    return count
+
+def account_mapping(categories, target):
+    '''A mapping, like csvmapping.load_account_mapping() returns, that maps
+    each generated category to an account in the target system.'''
+    # FlexHRM accounts are (time code, company, project)
+    flexhrm = target == 'flexhrm'
+    mapping = { 'generic': [('LUNCH',)],
+                timerec.name: [None],
+                target: [('Lunch', '', '') if flexhrm else None] }
+    for i in range(categories):
+        # Zero padded, so that no name is a substring of another
+        project = f'Project {i + 1:03}'
+        mapping['generic'].append(None)
+        mapping[timerec.name].append(category_account(i))
+        mapping[target].append(('Normal', '', project) if flexhrm
+                               else (project, 'Activity'))
+    return mapping
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--years', type=float, default=1)
+    parser.add_argument('--entries-per-day', type=int, default=8)
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('filename')
+    args = parser.parse_args()
+    count = generate(args.filename, args.years, args.entries_per_day,
+                     args.categories, args.seed)
+    print(f'Wrote {count} entries to {args.filename}')
+
+if __name__ == '__main__':
+    main()
@@ -7,29 +7,96 @@ logger = logging.getLogger(__name__)
 
 FILE_DIR = os.path.dirname(os.path.realpath(__file__))
 
-account_mapping = defaultdict(list)
-
-with open(FILE_DIR + '/mapping.csv', newline='') as csv_file:
-    reader = csv.reader(csv_file)
-
-    headers = next(reader)
-    column_mapping = defaultdict(list)
-    for i, header in enumerate(headers):
-        system, _, subinfo = header.partition('-')
-        column_mapping[system].append(i)
-
-    for row in reader:
-        for system, columns in column_mapping.items():
-            account = tuple(row[c] for c in columns)
-            empty = True
-            for c in account:
-                if c:
-                    empty = False
-                    break
-            if empty:
-                # No data on this line. It should be ignored
-                # when mapped to this system.
-                account = None
-            account_mapping[system].append(account)
-
-logger.debug(f'CSV Account mapping {account_mapping}')
+MAPPING_FILE = FILE_DIR + '/mapping.csv'
+
+class _FileMapping(defaultdict):
+    '''The mapping from mapping.csv, as returned by get_account_mapping().'''
+    pass
+
+_account_mapping = None
+# Modification time of the file when it was loaded
+_account_mapping_mtime = None
+
+def load_account_mapping(filename=MAPPING_FILE):
+    account_mapping = defaultdict(list)
+
+    with open(filename, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+
+        headers = next(reader)
+        column_mapping = defaultdict(list)
+        for i, header in enumerate(headers):
+            system, _, subinfo = header.partition('-')
+            column_mapping[system].append(i)
+
+        for row in reader:
+            for system, columns in column_mapping.items():
+                account = tuple(row[c] for c in columns)
+                empty = True
+                for c in account:
+                    if c:
+                        empty = False
+                        break
+                if empty:
+                    # No data on this line. It should be ignored
+                    # when mapped to this system.
+                    account = None
+                account_mapping[system].append(account)
+
+    logger.debug(f'CSV Account mapping {account_mapping}')
+    return account_mapping
+
+def get_account_mapping():
+    '''Returns the mapping from mapping.csv, which is loaded on first use.'''
+    global _account_mapping, _account_mapping_mtime
+    if _account_mapping is None:
+        _account_mapping_mtime = os.path.getmtime(MAPPING_FILE)
+        _account_mapping = _FileMapping(list, load_account_mapping(MAPPING_FILE))
+    return _account_mapping
+
+def is_file_mapping(account_mapping):
+    '''
+    Whether account_mapping was returned by get_account_mapping(), at any
+    time. It can be out of date, if the file has changed since.
+    '''
+    return isinstance(account_mapping, _FileMapping)
+
+def forget_changed_mapping():
+    '''
+    For long-running processes. Makes get_account_mapping() load the file
+    again, if it has changed since it was loaded. Returns True if so.
+    '''
+    global _account_mapping
+    if (_account_mapping is None or
+        os.path.getmtime(MAPPING_FILE) == _account_mapping_mtime):
+        return False
+    _account_mapping = None
+    return True
+
+def __getattr__(name):
+    # For configs that do "from csvmapping import account_mapping"
+    if name == 'account_mapping':
+        return get_account_mapping()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def index_accounts(account_mapping):
+    '''Builds a reverse index, account -> row, for each system.
+
+    Returns the index and, for each system, a list of (account, rows)
+    for accounts that appear on more than one row. The first row wins
+    in the index, just like list.index().'''
+    account_index = {}
+    duplicate_accounts = {}
+    for system, accounts in account_mapping.items():
+        index = {}
+        rows = defaultdict(list)
+        for row, account in enumerate(accounts):
+            if account is None:
+                continue
+            index.setdefault(account, row)
+            rows[account].append(row)
+        account_index[system] = index
+        duplicate_accounts[system] = [(account, account_rows)
+                                      for account, account_rows in rows.items()
+                                      if len(account_rows) > 1]
+    return account_index, duplicate_accounts
@@ -15,21 +15,28 @@
 # You should have received a copy of the GNU General Public License
 # along with time-reporting.  If not, see <https://www.gnu.org/licenses/>.
 
+import copy
 import datetime
-import requests
+import functools
 import pickle
 import time
+import uuid
 import json
-import bs4
 import html
 import logging
+import threading
 
 import config
 import htmlutils
+import httputils
 
 name = 'flexhrm'
 
 COOKIE_FILE = 'flexhrm_cookies.pickle'
+LOOKUP_CACHE_FILE = 'flexhrm_lookups.pickle'
+
+# Override with flexhrm_lookup_max_age in config
+DEFAULT_LOOKUP_MAX_AGE = datetime.timedelta(days=7)
 
 logger = logging.getLogger(__name__)
 
@@ -45,45 +52,157 @@ class Session:
         self.ask_password = config.flexhrm_ask_password
         self.password = None
         self.token = None
+        # Whether the token is the one from the last Save redirect, which
+        # set_days() uses for the next day instead of asking for a new one
+        self.token_from_save = False
         self.company_id = None
-        self.time_code_cache = {}
-        self.project_cache = {}
-        self.company_cache = {}
+        self.employee_id = None
+        # When the login was last known to work
+        self.validated_time = None
+        # (dimension, name substring) -> (lookup time, matches)
+        self.lookup_cache = {}
+        # (date, fields) of an empty row, used to create new rows locally
+        self.row_template = None
+        # Values from a Dagredovisning page that the lookups need, see
+        # _page_metadata(). Saved with the cookies.
+        self.metadata = None
+        # Whether the metadata has been read from a page in this session,
+        # rather than loaded from the last run
+        self.metadata_validated = False
         
-        self.session = requests.Session()
+        # Shared with the clones, which use the same login
+        self.login_lock = threading.Lock()
+        self.session = self._new_session()
         # Need user-agent to not get redirected to InternalServerError page
         self.session.headers = {
             'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:87.0) Gecko/20100101 Firefox/87.0'
         }
         
         self.load_cookies()
+        self.load_lookup_cache()
 
     def __enter__(self):
-        self.log_in()
+        # A recent login is used without checking it. If it has expired,
+        # the first request ends up on the login page, and we log in then.
+        if httputils.is_fresh(self.validated_time) and self.employee_id:
+            logger.debug('Using the login from the last run')
+        else:
+            with self.session.login():
+                self.log_in()
+            self.validated_time = datetime.datetime.now()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         # Cannot use  __del__ as Python functions (e.g. open()) are
         # removed at that point...
         self.save_cookies()
+        self.save_lookup_cache()
+
+    def clone(self):
+        '''
+        Returns a Session that shares the login (cookie jar) and caches
+        with this one, but has its own HTTP connections. Used for
+        uploading from several threads.
+        '''
+        clone = copy.copy(self)
+        clone.session = clone._new_session()
+        clone.session.headers = self.session.headers.copy()
+        clone.session.cookies = self.session.cookies
+        clone.token_from_save = False
+        return clone
+
+    def close_clone(self, clone):
+        '''
+        Takes over the login state of a clone from clone() when it is no
+        longer used, so that it is saved, and closes its HTTP connections.
+        '''
+        # The clones get new tokens for the same login. Any recent one
+        # works, so take the one from the clone that finished last.
+        self.token = clone.token
+        self.validated_time = httputils.latest_time(self.validated_time,
+                                                    clone._last_validated())
+        if clone.metadata_validated:
+            self.metadata = clone.metadata
+            self.metadata_validated = True
+        if self.row_template is None:
+            self.row_template = clone.row_template
+        clone.session.close()
+
+    def _last_validated(self):
+        # Requests that worked show that the login works, too
+        return httputils.latest_time(self.validated_time,
+                                     self.session.validated_time)
+
+    def _new_session(self):
+        return httputils.new_session(self._is_login_page, self._log_in_again,
+                                     self.login_lock)
 
     def load_cookies(self):
         try:
             with open(COOKIE_FILE, 'rb') as cookie_file:
-                cookies, token = pickle.load(cookie_file)
-                self.token = token
-                self.session.cookies.update(cookies)
+                data = pickle.load(cookie_file)
         except FileNotFoundError:
-            pass
+            return
+        if isinstance(data, list):
+            # Older files: [cookies, token] or [cookies, token, metadata]
+            data = dict(zip(('cookies', 'token', 'metadata'), data))
+        self.session.cookies.update(data['cookies'])
+        self.token = data['token']
+        self.metadata = data.get('metadata')
+        self.company_id = data.get('company_id')
+        self.employee_id = data.get('employee_id')
+        self.validated_time = data.get('validated_time')
 
     def save_cookies(self):
         with open(COOKIE_FILE, 'wb') as cookie_file:
-            pickle.dump([self.session.cookies, self.token], cookie_file)
+            pickle.dump({ 'cookies': self.session.cookies,
+                          'token': self.token,
+                          'metadata': self.metadata,
+                          'company_id': self.company_id,
+                          'employee_id': self.employee_id,
+                          'validated_time': self._last_validated() },
+                        cookie_file)
+
+    def load_lookup_cache(self):
+        try:
+            with open(LOOKUP_CACHE_FILE, 'rb') as cache_file:
+                lookup_cache = pickle.load(cache_file)
+        except FileNotFoundError:
+            return
+        max_age = getattr(config, 'flexhrm_lookup_max_age',
+                          DEFAULT_LOOKUP_MAX_AGE)
+        now = datetime.datetime.now()
+        self.lookup_cache.update((key, value)
+                                 for key, value in lookup_cache.items()
+                                 if now - value[0] <= max_age)
+
+    def save_lookup_cache(self):
+        with open(LOOKUP_CACHE_FILE, 'wb') as cache_file:
+            pickle.dump(self.lookup_cache, cache_file)
+
+    def _is_login_page(self, resp):
+        # set_days() does not follow the Save redirect, which then points
+        # to the login page instead
+        return ('/HRM/Login' in resp.url or resp.status_code == 401 or
+                '/HRM/Login' in resp.headers.get('Location', ''))
+
+    def _log_in_again(self, request_kwargs):
+        self.log_in()
+        self.validated_time = datetime.datetime.now()
+        # If a clone has logged in already, log_in() did nothing, and this
+        # session still has a token of the old login
+        self.get_request_token(ref=f'{self.baseurl}/HRM/')
+        # The request was made with the token of the old login
+        headers = request_kwargs.get('headers')
+        if headers and '__RequestVerificationToken' in headers:
+            request_kwargs['headers'] = { **headers,
+                                          '__RequestVerificationToken': self.token }
+        return request_kwargs
 
     def is_logged_in(self):
         resp = self.session.get(f'{self.baseurl}/HRM/')
         logged_in = 'HRM/Home?f=' in resp.url
-        bs = bs4.BeautifulSoup(resp.content, 'html.parser')
+        bs = htmlutils.parse_html(resp.content)
         if logged_in:
             self.company_id = resp.url.split('?f=')[1]
 
@@ -157,7 +276,7 @@ class Session:
         except json.decoder.JSONDecodeError:
             # Not JSON
             # Look for error in HTML
-            bs = bs4.BeautifulSoup(resp.content, 'html.parser')
+            bs = htmlutils.parse_html(resp.content)
             err_div = bs.select_one('div.validation-summary-errors')
             if err_div:
                 reason = err_div.text.strip()
@@ -174,7 +293,7 @@ class Session:
         )
         home_resp = resp
 
-        bs = bs4.BeautifulSoup(resp.content, 'html.parser')
+        bs = htmlutils.parse_html(resp.content)
         self.employee_id = bs.select_one('input#MyCalendarAnstallningId')['value']
 
         resp = self.session.get(f'{self.baseurl}/HRM/AnvandarloggLogger/AddOrUpdatePost',
@@ -194,23 +313,36 @@ class Session:
         self.get_request_token(ref=home_resp.url)
         
     def set_day(self, date, flexhrm_entries):
+        # Nothing is saved until the Save request, so the day can be done
+        # again from the start
+        httputils.retry_login_expired(self._set_day, date, flexhrm_entries)
+
+    def set_days(self, days, saved):
+        '''
+        Set the entries for several days, like set_day() for each. days is
+        a list of (date, entries). saved(date, entries) is called as soon
+        as each day has been saved, as a later day can still fail.
+
+        The token from each Save redirect is used for the next day, instead
+        of asking for a new one after each page load, and the redirect is
+        not followed.
+        '''
+        for date, entries in days:
+            httputils.retry_login_expired(self._set_day, date, entries,
+                                          follow_redirect=False)
+            saved(date, entries)
+
+    def _set_day(self, date, flexhrm_entries, follow_redirect=True):
         # TODO: Allow setting of multiple rows
-        # Get initial form values
-        hyphen_date = date.strftime("%Y-%m-%d")
-        url = f'{self.baseurl}/HRM/Tid/Dagredovisning'
-        resp = self.session.get(url,
-                                params = { 'f': self.company_id,
-                                           'anstallningId': self.employee_id,
-                                           'datum': hyphen_date })
-        dag_resp = resp
-
-        # Must refresh the token every time after loading this (all?) page(s)?
-        self.get_request_token(ref=resp.url)
-
-        bs = bs4.BeautifulSoup(resp.content, 'html.parser')
+        # Get initial form values. A token from a Save redirect is only used
+        # once, and not at all if this attempt is redone after a new login.
+        refresh_token = not self.token_from_save
+        self.token_from_save = False
+        dag_resp, bs = self._get_day_page(date, refresh_token)
         form = bs.select_one('form#edit')
 
         fields = htmlutils.parse_form_fields(form)
+        self._update_metadata(self._page_metadata(bs, fields))
 
         #self.session.cookies.set('anstallningId', self.employee_id, domain=get from baseurl, path='/HRM/')
 
@@ -261,17 +393,18 @@ class Session:
                 # This GUID is fetched as part of creating the row
                 #fields[f'Tidrapportdag.Tidrader[{row_id}].Konteringar[{project_col_id}].Value.ForetagKonteringsdimensionId'] = ''
 
-        # Can we skip this?
-        resp = self.session.post(f'{self.baseurl}{lock_path}',
-                                 data=fields,
-                                 headers={
-                                     '__RequestVerificationToken': self.token,
-                                     'X-Requested-With': 'XMLHttpRequest',
-                                     'Referer': dag_resp.url
-                                 })
+        # Can we skip this? Only when asked to, until we know.
+        if lock_path and not getattr(config, 'flexhrm_skip_lock', False):
+            resp = self.session.post(f'{self.baseurl}{lock_path}',
+                                     data=fields,
+                                     headers={
+                                         '__RequestVerificationToken': self.token,
+                                         'X-Requested-With': 'XMLHttpRequest',
+                                         'Referer': dag_resp.url
+                                     })
 
-        #fields['ModelHasLock'] = '1'
-        self.token = resp.headers['AntiforgeryToken']
+            #fields['ModelHasLock'] = '1'
+            self.token = resp.headers['AntiforgeryToken']
 
         us_date_midnight = date.strftime("%m%%2F%d%%2F%Y") + "%2000%3A00%3A00"
         save_url = f'{self.baseurl}/HRM/Tid/Dagredovisning/Save'
@@ -286,7 +419,18 @@ class Session:
                                      'f': self.company_id
                                  },
                                  headers={ 'Referer': dag_resp.url,
-                                 })
+                                 },
+                                 allow_redirects=follow_redirect)
+
+        if not follow_redirect:
+            # We should be sent on to Dagredovisning
+            location = resp.headers.get('Location', '')
+            if (resp.status_code != 302 or '/Save' in location or
+                'AntiforgeryToken' not in resp.headers):
+                raise Exception(f'Failed to save {date}: {resp.status_code} {location}')
+            self.token = resp.headers['AntiforgeryToken']
+            self.token_from_save = True
+            return
 
         try:
             # We should be sent on to Dagredovisning
@@ -302,11 +446,123 @@ class Session:
             print(resp.headers)
             #print(resp.content)
 
-        # "Save" redirects to "Dagredovisning", so we need to get a new token
-        self.get_request_token(ref=resp.url)
+            # "Save" redirects to "Dagredovisning", so we need to get a new token
+            self.get_request_token(ref=resp.url)
         
         assert resp.status_code == 200
 
+    def prefetch_accounts(self, accounts):
+        '''
+        Looks up the IDs of all accounts up front, so that set_day() can
+        use cached values.
+        '''
+        accounts = [account for account in set(accounts)
+                    if not all(key in self.lookup_cache
+                               for key in self._lookup_keys(account))]
+        if not accounts:
+            return
+
+        for account in accounts:
+            self._account_to_ids(account, dagredovisning_bs=None)
+
+    def _get_day_page(self, date, refresh_token=True):
+        '''Loads the Dagredovisning page. Returns the response and the parsed page.'''
+        resp = self.session.get(f'{self.baseurl}/HRM/Tid/Dagredovisning',
+                                params = { 'f': self.company_id,
+                                           'anstallningId': self.employee_id,
+                                           'datum': date.strftime("%Y-%m-%d") })
+
+        # Must refresh the token every time after loading this (all?) page(s)?
+        if refresh_token:
+            self.get_request_token(ref=resp.url)
+
+        return resp, htmlutils.parse_html(resp.content)
+
+    def _page_metadata(self, dagredovisning_bs, fields):
+        '''
+        Returns the values of a Dagredovisning page that the lookups need:
+        the time group ID, the time code enums and the dimension ID of
+        each account column. fields are the form fields of the page.
+        '''
+        # The first row (there will be at least one row)
+        row_id = fields['Tidrapportdag.Tidrader.Index']
+        if isinstance(row_id, list):
+            row_id = row_id[0]
+        prefix = f'Tidrapportdag.Tidrader[{row_id}]'
+
+        time_code_input = dagredovisning_bs.find('input', {'name': f'{prefix}.Tidkod.Value.EntityDescription'})
+        account_col_ids = fields[f'{prefix}.Konteringar.Index']
+        return { 'time_group_id': dagredovisning_bs.select_one('#Tidgrupp_Id').get('value'),
+                 'time_code_enums': json.loads(time_code_input.get('data-extraparams')),
+                 'dimension_ids': [fields[f'{prefix}.Konteringar[{col_id}].Value.ForetagKonteringsdimensionId']
+                                   for col_id in account_col_ids] }
+
+    def _update_metadata(self, metadata):
+        # The time code enums can differ between days, but the time group
+        # and the dimensions decide what the lookups find
+        if self.metadata and any(metadata[key] != self.metadata[key]
+                                 for key in ('time_group_id', 'dimension_ids')):
+            logger.debug('Page metadata changed: %r -> %r', self.metadata, metadata)
+            # Lookups made with the old values may be wrong
+            self.lookup_cache.clear()
+        self.metadata = metadata
+        self.metadata_validated = True
+
+    def _get_metadata(self, dagredovisning_bs=None):
+        '''
+        Returns the page metadata. It is read from dagredovisning_bs or
+        a newly loaded page, unless it is already known.
+        '''
+        if self.metadata is None:
+            if dagredovisning_bs is None:
+                _, dagredovisning_bs = self._get_day_page(datetime.date.today())
+            form = dagredovisning_bs.select_one('form#edit')
+            self._update_metadata(self._page_metadata(dagredovisning_bs,
+                                                      htmlutils.parse_form_fields(form)))
+        return self.metadata
+
+    def _metadata_lookup(self, lookup, dagredovisning_bs):
+        '''
+        Returns lookup(metadata). Metadata from the last run is trusted
+        until a lookup fails or finds nothing. Then it is read from a page
+        again and the lookup retried.
+        '''
+        # The lookups are sent with the token, so they are done again with
+        # the new one if the login expires
+        lookup = functools.partial(httputils.retry_login_expired, lookup)
+        metadata = self._get_metadata(dagredovisning_bs)
+        if self.metadata_validated:
+            return lookup(metadata)
+        try:
+            matches = lookup(metadata)
+            if matches:
+                return matches
+        except Exception as e:
+            logger.debug('Lookup with saved page metadata failed: %r', e)
+        self.metadata = None
+        return lookup(self._get_metadata(dagredovisning_bs))
+
+    def _lookup_keys(self, account):
+        time_code, consultancy_company, project = account
+        keys = [('time_code', time_code)]
+        if consultancy_company:
+            keys.append(('company', consultancy_company))
+        if project:
+            keys.append(('project', project))
+        return keys
+
+    def _cached_lookup(self, dimension, name_substring, lookup):
+        cached_value = self.lookup_cache.get((dimension, name_substring))
+        if cached_value:
+            logging.debug('Using cached %s value: %s', dimension, cached_value[1])
+            return cached_value[1]
+        matches = lookup()
+        # Don't remember misses, as the account might be added later
+        if matches:
+            self.lookup_cache[(dimension, name_substring)] = (datetime.datetime.now(),
+                                                              matches)
+        return matches
+
     def _account_to_ids(self, account, dagredovisning_bs):
         time_code, consultancy_company, project = account
 
@@ -356,37 +612,63 @@ class Session:
                                  }
         )
 
-        bs = bs4.BeautifulSoup(resp.content, 'html.parser')
+        bs = htmlutils.parse_html(resp.content)
         row_div = bs.select_one('div.row')
         return row_div
 
     def _get_new_row(self, fields, date):
-        row_div = self._get_new_row_raw(date)
-        htmlutils.parse_form_fields(row_div, fields)
+        if not getattr(config, 'flexhrm_row_template', False):
+            row_div = self._get_new_row_raw(date)
+            htmlutils.parse_form_fields(row_div, fields)
+            return
 
-    def _find_time_code(self, name_substring, dagredovisning_bs=None):
-        cached_value = self.time_code_cache.get(name_substring)
-        if cached_value:
-            logging.debug('Using cached time code value: %s', cached_value)
-            return cached_value
-        
-        # Find the first row ID (there will be at least one row)
-        row_id = dagredovisning_bs.find('input', {'name': 'Tidrapportdag.Tidrader.Index'}).get('value')
+        if not self.row_template:
+            row_div = self._get_new_row_raw(date)
+            self.row_template = (date, htmlutils.parse_form_fields(row_div))
+        self._add_row_from_template(fields, date)
+
+    def _add_row_from_template(self, fields, date):
+        # The row ID is only used to group the fields of a row (like a
+        # GUID from BeginCollectionItem), so a fresh one works as well
+        # as one from the server
+        template_date, template = self.row_template
+        template_row_id = template['Tidrapportdag.Tidrader.Index']
+        row_id = str(uuid.uuid4())
+        template_prefix = f'Tidrapportdag.Tidrader[{template_row_id}]'
+        prefix = f'Tidrapportdag.Tidrader[{row_id}]'
+        template_hyphen_date = template_date.strftime("%Y-%m-%d")
+        hyphen_date = date.strftime("%Y-%m-%d")
 
-        time_code_input = dagredovisning_bs.find('input', {'name': f'Tidrapportdag.Tidrader[{row_id}].Tidkod.Value.EntityDescription'})
-        time_code_enums_encoded = time_code_input.get('data-extraparams')
-        time_code_enums = json.loads(time_code_enums_encoded)
+        for name, value in template.items():
+            if name == 'Tidrapportdag.Tidrader.Index':
+                value = row_id
+            else:
+                name = name.replace(template_prefix, prefix, 1)
+            values = value if isinstance(value, list) else [value]
+            for v in values:
+                htmlutils.add_form_field(fields, name,
+                                         v.replace(template_hyphen_date,
+                                                   hyphen_date))
 
-        time_group_id = dagredovisning_bs.select_one('#Tidgrupp_Id').get('value')
+    def _find_time_code(self, name_substring, dagredovisning_bs=None):
+        return self._cached_lookup('time_code', name_substring,
+                                   lambda: self._find_time_code_raw(name_substring,
+                                                                    dagredovisning_bs))
+
+    def _find_time_code_raw(self, name_substring, dagredovisning_bs):
+        return self._metadata_lookup(lambda metadata: self._find_time_code_req(name_substring,
+                                                                               metadata),
+                                     dagredovisning_bs)
 
+    def _find_time_code_req(self, name_substring, metadata):
         limit = 15
         data = {
             'term': name_substring,
             'limit': str(limit),
             'valueType': 'EntityDescription',
-            'tidgruppId': time_group_id,
+            'tidgruppId': metadata['time_group_id'],
         }
-        data.update(time_code_enums)
+        data.update(metadata['time_code_enums'])
 
         us_date_midnight = datetime.date.today().strftime("%m%%2F%d%%2F%Y") + "%2000%3A00%3A00"
         resp = self.session.post(f'{self.baseurl}/HRM/Tid/TidredovisningTidkod/AutoComplete',
@@ -398,57 +680,32 @@ class Session:
                          }
         )
         resp_json = json.loads(resp.content)
-        matches = [(match['label'], match['id']) for match in resp_json]
-        self.time_code_cache[name_substring] = matches
-        return matches
+        return [(match['label'], match['id']) for match in resp_json]
         
     def find_project(self, name_substring, dagredovisning_bs=None):
-        cached_value = self.project_cache.get(name_substring)
-        if cached_value:
-            logging.debug('Using cached project value: %s', cached_value)
-            return cached_value
-
         # page='AutoComplete' works here as well
-        matches = self._auto_complete('AutoCompleteProjektByDeltagare',
-                                      self.PROJECT_ACCOUNT_COL_INDEX,
-                                      name_substring,
-                                      dagredovisning_bs=dagredovisning_bs)
-        self.project_cache[name_substring] = matches
-        return matches
+        return self._cached_lookup('project', name_substring,
+                                   lambda: self._auto_complete('AutoCompleteProjektByDeltagare',
+                                                               self.PROJECT_ACCOUNT_COL_INDEX,
+                                                               name_substring,
+                                                               dagredovisning_bs=dagredovisning_bs))
 
     def find_company(self, name_substring, dagredovisning_bs=None):
-        cached_value = self.company_cache.get(name_substring)
-        if cached_value:
-            logging.debug('Using cached company value: %s', cached_value)
-            return cached_value
-
-        matches = self._auto_complete('AutoComplete',
-                                      self.COMPANY_ACCOUNT_COL_INDEX,
-                                      name_substring,
-                                      dagredovisning_bs=dagredovisning_bs)
-        self.company_cache[name_substring] = matches
-        return matches
+        return self._cached_lookup('company', name_substring,
+                                   lambda: self._auto_complete('AutoComplete',
+                                                               self.COMPANY_ACCOUNT_COL_INDEX,
+                                                               name_substring,
+                                                               dagredovisning_bs=dagredovisning_bs))
 
     def _auto_complete(self, page, col_index, name_substring, limit=15,
                        dagredovisning_bs=None):
-        # We need the "dimension" GUID
-        fields = {}
-        if dagredovisning_bs:
-            # Cached response
-            form = dagredovisning_bs.select_one('form#edit')
-            htmlutils.parse_form_fields(form, fields)
-        else:
-            # No cached response, grab a new row to get our data
-            self._get_new_row(fields, datetime.date.today())
-
-        row_id = fields['Tidrapportdag.Tidrader.Index']
-        if isinstance(row_id, list):
-            row_id = row_id[0]
-        account_col_ids = fields[f'Tidrapportdag.Tidrader[{row_id}].Konteringar.Index']
-        col_id = account_col_ids[col_index]
-
-        dimension_id = fields[f'Tidrapportdag.Tidrader[{row_id}].Konteringar[{col_id}].Value.ForetagKonteringsdimensionId']
+        return self._metadata_lookup(lambda metadata: self._auto_complete_req(page,
+                                                                              metadata['dimension_ids'][col_index],
+                                                                              name_substring,
+                                                                              limit),
+                                     dagredovisning_bs)
 
+    def _auto_complete_req(self, page, dimension_id, name_substring, limit):
         us_date_midnight = datetime.date.today().strftime("%m%%2F%d%%2F%Y") + "%2000%3A00%3A00"
         resp = self.session.post(f'{self.baseurl}/HRM/Kontering/{dimension_id}/{page}',
                          data={
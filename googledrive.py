@@ -1,15 +1,37 @@
-import requests
+import httputils
 
-def download_file(fileid, filename):
-    session = requests.Session()
-    resp = session.get(f'https://drive.google.com/uc?export=download',
-                       params={ 'id': fileid })
+CHUNK_SIZE = 1024 * 1024
+
+def open_file(fileid, headers=None):
+    '''
+    Returns a streamed response for the file. The caller should close it.
+
+    headers can hold conditional request headers, like If-None-Match, in
+    which case the status code can be 304.
+    '''
+    session = httputils.new_session()
+    url = f'https://drive.google.com/uc?export=download'
+    resp = session.get(url, params={ 'id': fileid }, headers=headers,
+                       stream=True)
     resp.raise_for_status()
 
     token = resp.cookies.get('download_warning')
-            
-    resp = session.get(f'https://drive.google.com/uc?export=download',
-                       params={ 'confirm': token, 'id': fileid })
+    if not token and not resp.headers.get('Content-Type', '').startswith('text/html'):
+        # Small files are sent directly, without a virus scan warning page
+        return resp
+    resp.close()
+
+    resp = session.get(url, params={ 'confirm': token, 'id': fileid },
+                       headers=headers, stream=True)
     resp.raise_for_status()
+    return resp
+
+def iter_file(fileid, chunk_size=CHUNK_SIZE):
+    '''Yields the file contents in chunks, without keeping it all in memory.'''
+    with open_file(fileid) as resp:
+        yield from resp.iter_content(chunk_size)
+
+def download_file(fileid, filename):
     with open(filename, 'wb') as f:
-        f.write(resp.content)
+        for chunk in iter_file(fileid):
+            f.write(chunk)
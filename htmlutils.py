@@ -1,6 +1,25 @@
+import html.parser
+import re
+
 import bs4
 
+import profiling
+
+try:
+    import lxml
+    TREE_PARSER = 'lxml'
+except ImportError:
+    TREE_PARSER = 'html.parser'
+
+def parse_html(markup, parser='html.parser'):
+    with profiling.phase('html parsing'):
+        return bs4.BeautifulSoup(markup, parser)
+
 def parse_form_fields(html_form, fields=None):
+    with profiling.phase('html parsing'):
+        return _parse_form_fields(html_form, fields)
+
+def _parse_form_fields(html_form, fields):
     # All fields sent through POST has a "name" set
     form_fields = html_form.select('[name]')
     # <select> and <textarea> does not have a "value" attribute
@@ -8,7 +27,7 @@ def parse_form_fields(html_form, fields=None):
         fields = {}
     for form_field in form_fields:
         if form_field.name == 'input':
-            if form_field['type'] == 'image':
+            if form_field.get('type') == 'image':
                 # Drop image button
                 continue
             value = form_field.get('value', '')
@@ -18,19 +37,129 @@ def parse_form_fields(html_form, fields=None):
         elif form_field.name == 'select':
             # TODO: Check for "option" tag "DEFAULT" marker, if needed
             option = form_field.select_one('option')
-            value = option.get('value', '')
-        name = form_field['name']
-        if name in fields:
-            prev_value = fields[name]
-            if isinstance(prev_value, list):
-                prev_value.append(value)
-            else:
-                fields[name] = [prev_value, value]
+            value = option.get('value', '') if option else ''
         else:
-            fields[name] = value
+            value = form_field.get('value', '')
+        add_form_field(fields, form_field['name'], value)
     return fields
 
+def add_form_field(fields, name, value):
+    # Repeated names are collected in a list, in the order they appear
+    if name in fields:
+        prev_value = fields[name]
+        if isinstance(prev_value, list):
+            prev_value.append(value)
+        else:
+            fields[name] = [prev_value, value]
+    else:
+        fields[name] = value
+
+class NoMatchingElement(Exception):
+    '''Raised by form_fields_from_selector() if nothing matches the selector.'''
+    pass
+
+class _StopParsing(Exception):
+    pass
+
+class FormFieldExtractor(html.parser.HTMLParser):
+    '''
+    Collects the same fields as parse_form_fields(), in one pass over the
+    HTML, without building a tree. Only the first element matching tag
+    and/or element_id is used.
+    '''
+    def __init__(self, tag, element_id):
+        super().__init__()
+        self.tag = tag
+        self.element_id = element_id
+        self.found = False
+        # Depth of self.tag elements inside the matching element
+        self.depth = 0
+        # [name, value] in document order. The value of a <select> is set
+        # when its first <option> is seen.
+        self.pairs = []
+        self.open_select = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = { name: value if value is not None else ''
+                  for name, value in attrs }
+        if self.depth == 0:
+            if self.found:
+                return
+            if ((not self.tag or tag == self.tag) and
+                (self.element_id is None or attrs.get('id') == self.element_id)):
+                self.found = True
+                self.depth = 1
+                # For counting nested elements, when only matching by ID
+                self.tag = tag
+            return
+
+        if tag == self.tag:
+            self.depth += 1
+
+        if tag == 'option' and self.open_select is not None:
+            self.open_select[1] = attrs.get('value', '')
+            self.open_select = None
+
+        if 'name' not in attrs:
+            return
+        if tag == 'input':
+            if attrs.get('type') == 'image':
+                # Drop image button
+                return
+            value = attrs.get('value', '')
+        elif tag in ('textarea', 'select'):
+            value = ''
+        else:
+            value = attrs.get('value', '')
+        pair = [attrs['name'], value]
+        if tag == 'select':
+            self.open_select = pair
+        self.pairs.append(pair)
+
+    def handle_endtag(self, tag):
+        if self.depth == 0:
+            return
+        if tag == 'select':
+            self.open_select = None
+        if tag == self.tag:
+            self.depth -= 1
+            if self.depth == 0:
+                # Nothing more to collect
+                raise _StopParsing()
+
+    def fields(self):
+        fields = {}
+        for name, value in self.pairs:
+            add_form_field(fields, name, value)
+        return fields
+
+# tag#id, tag or #id
+SIMPLE_SELECTOR_RE = re.compile(r'^([a-zA-Z][a-zA-Z0-9]*)?(?:#([\w$-]+))?$')
+
 def form_fields_from_selector(html, selector):
-    bs = bs4.BeautifulSoup(html, 'html.parser')
-    form = bs.select_one(selector)
-    return parse_form_fields(form)
+    with profiling.phase('html parsing'):
+        return _form_fields_from_selector(html, selector)
+
+def _form_fields_from_selector(html, selector):
+    match = SIMPLE_SELECTOR_RE.match(selector)
+    if not match or not any(match.groups()):
+        # Build a tree for other selectors
+        bs = bs4.BeautifulSoup(html, TREE_PARSER)
+        form = bs.select_one(selector)
+        if form is None:
+            raise NoMatchingElement(f'No element matches {selector}')
+        return _parse_form_fields(form, None)
+
+    if isinstance(html, bytes):
+        # Same encoding detection as BeautifulSoup
+        html = bs4.UnicodeDammit(html, is_html=True).unicode_markup
+    tag, element_id = match.groups()
+    extractor = FormFieldExtractor(tag.lower() if tag else None, element_id)
+    try:
+        extractor.feed(html)
+        extractor.close()
+    except _StopParsing:
+        pass
+    if not extractor.found:
+        raise NoMatchingElement(f'No element matches {selector}')
+    return extractor.fields()
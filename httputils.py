@@ -0,0 +1,267 @@
+# HTTP sessions for the backends, with shared settings for connection
+# pooling, timeouts and retries. Every request is recorded, so that a run
+# can show how many round trips and connections it needed.
+
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import logging
+import queue
+import re
+import threading
+import time
+import urllib.parse
+import weakref
+
+import requests
+import requests.adapters
+from urllib3.util.retry import Retry
+
+import config
+import profiling
+
+logger = logging.getLogger(__name__)
+
+# Override with http_timeout, http_retries and http_pool_size in config
+DEFAULT_TIMEOUT = (10, 60) # (connect, read) seconds
+DEFAULT_RETRIES = 3
+DEFAULT_POOL_SIZE = 10
+# Number of catalog lists fetched at the same time. Override with
+# catalog_jobs in config.
+DEFAULT_CATALOG_JOBS = 4
+# How long a login is trusted without checking it. Override with
+# session_max_age in config.
+DEFAULT_SESSION_MAX_AGE = datetime.timedelta(minutes=10)
+
+Request = collections.namedtuple('Request', ['method', 'path', 'status',
+                                             'bytes', 'latency', 'round_trips'])
+
+# Requests that are sent again after logging in again. Other requests
+# can carry state from the old login, e.g. form tokens.
+RESEND_METHODS = ('GET', 'HEAD')
+
+_requests = []
+_requests_lock = threading.Lock()
+_sessions = weakref.WeakSet()
+# Connections opened by sessions that no longer exist
+_finished_connections = 0
+
+class LoginExpired(Exception):
+    '''
+    The login had expired, and a new login has been made. The request was
+    not sent again, as it can depend on the old login. Load the page again
+    and retry, e.g. with retry_login_expired().
+    '''
+    pass
+
+class Session(requests.Session):
+    '''
+    requests.Session with a default timeout, that records each request.
+
+    If is_login_page(response) is set and returns True, the login has
+    expired. Then log_in_again(kwargs) is called, which should log in and
+    return the keyword arguments for sending the request again. GET and
+    HEAD requests are sent again, others raise LoginExpired.
+
+    Sessions that share a login (cookies) should share login_lock, so that
+    only one of them logs in again at a time. The others then find that
+    they are already logged in.
+    '''
+    def __init__(self, is_login_page=None, log_in_again=None, login_lock=None):
+        super().__init__()
+        self.is_login_page = is_login_page
+        self.log_in_again = log_in_again
+        self.login_lock = login_lock if login_lock else threading.Lock()
+        # When a response last showed that the login works, i.e. did not
+        # end up on the login page
+        self.validated_time = None
+        # Set while logging in, as that makes requests that end up on the
+        # login page
+        self.logging_in = False
+        self.timeout = getattr(config, 'http_timeout', DEFAULT_TIMEOUT)
+        # Only idempotent methods are retried after a response or a read
+        # error. A failed connect is retried for all methods, as nothing
+        # was sent.
+        retries = Retry(total=getattr(config, 'http_retries', DEFAULT_RETRIES),
+                        backoff_factor=0.5,
+                        status_forcelist=(502, 503, 504),
+                        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                        raise_on_status=False)
+        pool_size = getattr(config, 'http_pool_size', DEFAULT_POOL_SIZE)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size,
+                                                max_retries=retries)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        _sessions.add(self)
+        weakref.finalize(self, _session_finished, [adapter])
+
+    def request(self, method, url, **kwargs):
+        resp = self._recorded_request(method, url, **kwargs)
+        if not self.is_login_page or self.logging_in:
+            return resp
+        if not self.is_login_page(resp):
+            if resp.status_code < 400:
+                self.validated_time = datetime.datetime.now()
+            return resp
+
+        # The login has expired
+        resp.close()
+        with self.login_lock:
+            logger.info('Login has expired. Logging in again.')
+            with self.login():
+                kwargs = self.log_in_again(kwargs)
+        if method.upper() not in RESEND_METHODS:
+            raise LoginExpired(f'Login expired during {method.upper()} {path_template(url)}')
+        resp = self._recorded_request(method, url, **kwargs)
+        return resp
+
+    def close(self):
+        # Closing clears the connection pools, so count them first
+        _session_finished(set(self.adapters.values()))
+        super().close()
+
+    @contextlib.contextmanager
+    def login(self):
+        '''Turns off the login page check, for the requests made while logging in.'''
+        self.logging_in = True
+        try:
+            yield
+        finally:
+            self.logging_in = False
+
+    def _recorded_request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.perf_counter()
+        with profiling.phase('http'):
+            resp = super().request(method, url, **kwargs)
+        if kwargs.get('stream'):
+            # Don't read the body here
+            size = int(resp.headers.get('Content-Length', 0))
+        else:
+            size = len(resp.content)
+        latency = time.perf_counter() - start
+        with _requests_lock:
+            _requests.append(Request(method.upper(), path_template(url),
+                                     resp.status_code, size, latency,
+                                     1 + len(resp.history)))
+        return resp
+
+def new_session(is_login_page=None, log_in_again=None, login_lock=None):
+    return Session(is_login_page, log_in_again, login_lock)
+
+def retry_login_expired(fn, *args, **kwargs):
+    '''
+    Returns fn(*args, **kwargs). If the login expired on the way, fn is
+    called once more, which should load any forms again.
+    '''
+    try:
+        return fn(*args, **kwargs)
+    except LoginExpired as e:
+        logger.info(f'{e}. Trying again.')
+        return fn(*args, **kwargs)
+
+def latest_time(*times):
+    '''The latest of times that are not None, or None.'''
+    return max((t for t in times if t is not None), default=None)
+
+def is_fresh(validated_time):
+    '''
+    Whether a login that was last checked at validated_time can be used
+    without checking it again.
+    '''
+    if validated_time is None:
+        return False
+    max_age = getattr(config, 'session_max_age', DEFAULT_SESSION_MAX_AGE)
+    return datetime.datetime.now() - validated_time <= max_age
+
+def catalog_jobs():
+    return getattr(config, 'catalog_jobs', DEFAULT_CATALOG_JOBS)
+
+def map_concurrently(fn, sessions, items):
+    '''
+    Returns [fn(session, item) for item in items], with the calls spread
+    over the sessions. Each session is used by one thread at a time, so
+    at most len(sessions) requests are in flight.
+    '''
+    if len(sessions) <= 1 or len(items) <= 1:
+        return [fn(sessions[0], item) for item in items]
+
+    free_sessions = queue.Queue()
+    for session in sessions:
+        free_sessions.put(session)
+
+    def call(item):
+        session = free_sessions.get()
+        try:
+            return fn(session, item)
+        finally:
+            free_sessions.put(session)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(sessions)) as executor:
+        return list(executor.map(call, items))
+
+# Parts of paths that differ between requests, e.g. IDs
+_GUID_RE = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+_NUMBER_RE = re.compile(r'(?<=/)\d+(?=/|$)')
+
+def path_template(url):
+    '''The URL path, without query and with IDs replaced.'''
+    path = urllib.parse.urlsplit(url).path
+    path = _GUID_RE.sub('{guid}', path)
+    return _NUMBER_RE.sub('{n}', path)
+
+def _count_connections(adapters):
+    count = 0
+    for adapter in adapters:
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            count += pools[key].num_connections
+    return count
+
+def _session_finished(adapters):
+    global _finished_connections
+    with _requests_lock:
+        _finished_connections += _count_connections(adapters)
+
+def connection_count():
+    '''Number of connections opened so far.'''
+    count = _finished_connections
+    for session in list(_sessions):
+        count += _count_connections(set(session.adapters.values()))
+    return count
+
+def clear_requests():
+    '''Forgets the requests made so far.'''
+    with _requests_lock:
+        _requests.clear()
+
+def log_summary():
+    '''Logs a table of the requests made so far, grouped by method and path.'''
+    with _requests_lock:
+        recorded = list(_requests)
+    if not recorded:
+        return
+
+    groups = collections.defaultdict(list)
+    for r in recorded:
+        groups[(r.method, r.path)].append(r)
+    rows = []
+    for (method, path), group in groups.items():
+        total = sum(r.latency for r in group)
+        rows.append((total, method, path, len(group),
+                     sum(r.round_trips for r in group),
+                     sum(1 for r in group if r.status >= 400),
+                     sum(r.bytes for r in group)))
+    rows.sort(reverse=True)
+
+    logger.info('HTTP requests:')
+    logger.info(f'{"Method":6} {"Path":50} {"Count":>5} {"Trips":>5} {"Errors":>6} {"KiB":>8} {"Total s":>8} {"Mean ms":>8}')
+    for total, method, path, count, round_trips, errors, size in rows:
+        logger.info(f'{method:6} {path[-50:]:50} {count:5} {round_trips:5} {errors:6} '
+                    f'{size / 1024:8.1f} {total:8.2f} {total / count * 1000:8.1f}')
+    logger.info(f'{len(recorded)} requests, '
+                f'{sum(r.round_trips for r in recorded)} round trips, '
+                f'{connection_count()} connections, '
+                f'{sum(r.latency for r in recorded):.2f} s')
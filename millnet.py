@@ -15,21 +15,31 @@
 # You should have received a copy of the GNU General Public License
 # along with time-reporting.  If not, see <https://www.gnu.org/licenses/>.
 
-import bs4
+import copy
 import datetime
-import requests
 import pickle
 import time
 import json
 import logging
+import threading
 
 import config
 import htmlutils
+import httputils
 import timereporting
 
 name = 'millnet'
 
 COOKIE_FILE = 'millnet_cookies.pickle'
+CATALOG_FILE = 'millnet_catalog.pickle'
+
+# Override with millnet_catalog_max_age in config
+DEFAULT_CATALOG_MAX_AGE = datetime.timedelta(days=7)
+
+# Rows per request when listing projects
+PROJECT_PAGE_SIZE = 50
+# Number of project pages to fetch at the same time
+PROJECT_PAGE_JOBS = 4
 
 logger = logging.getLogger(__name__)
 
@@ -39,35 +49,226 @@ class Session:
         self.username = config.millnet_username
         self.ask_password = config.millnet_ask_password
         self.password = None
+        # Project rows, as returned by get_projects()
         self.project_list_cache = None
+        # Project name -> ID
+        self.project_ids = {}
+        # Project ID -> activity rows, as returned by get_activities()
         self.activity_list_cache = {}
-        self.session = requests.Session()
+        # Project ID -> activity name -> activity ID
+        self.activity_ids = {}
+        self.catalog_time = None
+        # Lists that were fetched by this session, as opposed to loaded
+        # from the catalog file
+        self.fresh_projects = False
+        self.fresh_activities = set()
+        # When the login was last known to work
+        self.validated_time = None
+        # Shared with the clones, which use the same login
+        self.login_lock = threading.Lock()
+        self.session = self._new_session()
         self.load_cookies()
+        self.load_catalog()
 
     def __enter__(self):
-        self.log_in()
+        # A recent login is used without checking it. If it has expired,
+        # the first request ends up on the login page, and we log in then.
+        if httputils.is_fresh(self.validated_time):
+            logger.debug('Using the login from the last run')
+        else:
+            with self.session.login():
+                self.log_in()
+            self.validated_time = datetime.datetime.now()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         # Cannot use  __del__ as Python functions (e.g. open()) are
         # removed at that point...
         self.save_cookies()
+        self.save_catalog()
+
+    def clone(self):
+        '''
+        Returns a Session that shares the login (cookie jar) and caches
+        with this one, but has its own HTTP connections. Used for
+        uploading from several threads.
+        '''
+        # Load the project list before cloning, so that all clones use the
+        # same list
+        if self.project_list_cache is None:
+            self._update_project_list()
+        return self._copy()
+
+    def _copy(self):
+        clone = copy.copy(self)
+        clone.session = clone._new_session()
+        clone.session.headers = self.session.headers.copy()
+        clone.session.cookies = self.session.cookies
+        return clone
+
+    def close_clone(self, clone):
+        '''
+        Takes over the login and catalog state of a clone from clone() or
+        _copy() when it is no longer used, so that it is saved, and closes
+        its HTTP connections.
+        '''
+        self.validated_time = httputils.latest_time(self.validated_time,
+                                                    clone._last_validated())
+        # The lists themselves are shared
+        if clone.fresh_projects:
+            self.fresh_projects = True
+            self.catalog_time = httputils.latest_time(self.catalog_time,
+                                                      clone.catalog_time)
+        clone.session.close()
+
+    def _last_validated(self):
+        # Requests that worked show that the login works, too
+        return httputils.latest_time(self.validated_time,
+                                     self.session.validated_time)
+
+    def _new_session(self):
+        return httputils.new_session(self._is_login_page, self._log_in_again,
+                                     self.login_lock)
 
     def load_cookies(self):
         try:
             with open(COOKIE_FILE, 'rb') as cookie_file:
-                self.session.cookies.update(pickle.load(cookie_file))
+                data = pickle.load(cookie_file)
         except FileNotFoundError:
-            pass
+            return
+        if isinstance(data, dict):
+            self.session.cookies.update(data['cookies'])
+            self.validated_time = data['validated_time']
+        else:
+            # Older files only have the cookies
+            self.session.cookies.update(data)
 
     def save_cookies(self):
         with open(COOKIE_FILE, 'wb') as cookie_file:
-            pickle.dump(self.session.cookies, cookie_file)
+            pickle.dump({ 'cookies': self.session.cookies,
+                          'validated_time': self._last_validated() },
+                        cookie_file)
+
+    def load_catalog(self):
+        '''
+        Loads the project and activity lists from the last run, unless
+        they are older than millnet_catalog_max_age.
+        '''
+        try:
+            with open(CATALOG_FILE, 'rb') as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            return
+        max_age = getattr(config, 'millnet_catalog_max_age',
+                          DEFAULT_CATALOG_MAX_AGE)
+        if datetime.datetime.now() - data['time'] > max_age:
+            logger.debug('Catalog cache is too old, ignoring it')
+            return
+        self.catalog_time = data['time']
+        self.project_list_cache = data['projects']
+        self.project_ids = {p['value']: p['id']
+                            for p in self.project_list_cache}
+        self.activity_list_cache = data['activities']
+        self.activity_ids = {project_id: self._activity_name_ids(activities)
+                             for project_id, activities
+                             in self.activity_list_cache.items()}
+
+    def save_catalog(self):
+        if not self.fresh_projects and not self.fresh_activities:
+            return
+        with open(CATALOG_FILE, 'wb') as f:
+            data = { 'time': self.catalog_time,
+                     'projects': self.project_list_cache,
+                     'activities': self.activity_list_cache }
+            pickle.dump(data, f)
+
+    def refresh_catalog(self):
+        '''
+        Fetches the project list and the activities of the projects that
+        the user is a member of.
+        '''
+        self.activity_list_cache = {}
+        self.activity_ids = {}
+        self._update_project_list()
+        self._update_activity_lists([p['id'] for p in self.project_list_cache
+                                     if p['groupname'] == 'Medlem'])
+
+    def prefetch_activities(self, project_ids):
+        '''
+        Fetches the activities of the projects that are not in the catalog,
+        several at a time, so that get_cached_activities() does not have to
+        wait for them one by one.
+        '''
+        self._update_activity_lists([project_id for project_id in project_ids
+                                     if project_id not in self.activity_list_cache])
+
+    def get_cached_projects(self):
+        '''Like get_projects(), but uses the catalog.'''
+        if self.project_list_cache is None:
+            self._update_project_list()
+        return self.project_list_cache
+
+    def get_cached_activities(self, project_id):
+        '''Like get_activities(), but uses the catalog.'''
+        if project_id not in self.activity_list_cache:
+            self._update_activity_list(project_id)
+        return self.activity_list_cache[project_id]
+
+    def _update_project_list(self):
+        projects = self.get_projects()
+        # Update in place, as clones share the list
+        if self.project_list_cache is None:
+            self.project_list_cache = projects
+        else:
+            self.project_list_cache[:] = projects
+        self.project_ids.clear()
+        self.project_ids.update((p['value'], p['id']) for p in projects)
+        self.catalog_time = datetime.datetime.now()
+        self.fresh_projects = True
+
+    def _update_activity_list(self, project_id):
+        self._set_activity_list(project_id, self.get_activities(project_id))
+
+    def _update_activity_lists(self, project_ids, jobs=None):
+        if jobs is None:
+            jobs = httputils.catalog_jobs()
+        # Not clone(), which would load the project list
+        copies = [self._copy() for _ in range(min(jobs, len(project_ids)) - 1)]
+        try:
+            activity_lists = httputils.map_concurrently(
+                lambda session, project_id: session.get_activities(project_id),
+                [self] + copies, project_ids)
+        finally:
+            for session in copies:
+                self.close_clone(session)
+        for project_id, activities in zip(project_ids, activity_lists):
+            self._set_activity_list(project_id, activities)
+
+    def _set_activity_list(self, project_id, activities):
+        self.activity_list_cache[project_id] = activities
+        self.activity_ids[project_id] = self._activity_name_ids(activities)
+        self.fresh_activities.add(project_id)
+
+    @staticmethod
+    def _activity_name_ids(activities):
+        # The first activity wins if names are repeated
+        name_ids = {}
+        for a in activities:
+            name_ids.setdefault(a['Name'], a['ActivityId'])
+        return name_ids
 
     def is_logged_in(self):
         resp = self.session.get(f"{self.baseurl}/cgi/milltime.cgi")
         assert resp.status_code == 200
-        return 'login' not in resp.url
+        return not self._is_login_page(resp)
+
+    def _is_login_page(self, resp):
+        return 'login' in resp.url
+
+    def _log_in_again(self, request_kwargs):
+        self.log_in()
+        self.validated_time = datetime.datetime.now()
+        return request_kwargs
 
     def log_in(self):
         if self.is_logged_in():
@@ -91,7 +292,9 @@ class Session:
         '''
         Set the entries for the given day. Hours are summed up.
         '''
+        httputils.retry_login_expired(self._set_day, date, entries)
 
+    def _set_day(self, date, entries):
         number_date = date.strftime("%Y%m%d")
         hyphen_date = date.strftime("%Y-%m-%d")
 
@@ -104,9 +307,8 @@ class Session:
                                      # date_* values says what date was last visited
                                  })
 
-        bs = bs4.BeautifulSoup(resp.content, 'html.parser')
-        form = bs.select_one('form#mt_main_form')
-        fields = htmlutils.parse_form_fields(form)
+        fields = htmlutils.form_fields_from_selector(resp.content,
+                                                     'form#mt_main_form')
 
         # ro_<number> contains a row ID for existing rows that have values
         # It seems that Millnet starts the IDs at 2, so we mark 0 as taken
@@ -207,23 +409,26 @@ class Session:
     def _account_to_ids(self, account):
         project, activity = account
 
-        if not self.project_list_cache:
-            self.project_list_cache = {p['value']: p['id']
-                                       for p in self.get_projects()}
+        # The cached lists can be out of date, so fetch them again
+        # before giving up
+        if (self.project_list_cache is None or
+            (project not in self.project_ids and not self.fresh_projects)):
+            self._update_project_list()
 
         try:
-            project_id = self.project_list_cache[project]
+            project_id = self.project_ids[project]
         except KeyError:
             raise Exception(f'Could not find project: {project}')
 
-        if project_id not in self.activity_list_cache:
-            self.activity_list_cache[project_id] = {a['Name']: a['ActivityId']
-                                                    for a in
-                                                    self.get_activities(project_id)}
+        activity_ids = self.activity_ids.get(project_id)
+        if (activity_ids is None or
+            (activity not in activity_ids and
+             project_id not in self.fresh_activities)):
+            self._update_activity_list(project_id)
+            activity_ids = self.activity_ids[project_id]
 
-        activities = self.activity_list_cache[project_id]
         try:
-            activity_id = activities[activity]
+            activity_id = activity_ids[activity]
         except KeyError:
             raise Exception(f'Could not find activity "{activity}" for project "{project}"')
 
@@ -232,9 +437,9 @@ class Session:
         return project_id, activity_id
         
         
-    def get_projects(self, limit=50):
+    def get_projects(self, limit=PROJECT_PAGE_SIZE, jobs=PROJECT_PAGE_JOBS):
         '''
-        Returns a list of projects
+        Returns a list of all projects, fetched limit rows at a time
 
         {'id': '300000000000000001',
          'value': 'Project name',
@@ -245,21 +450,61 @@ class Session:
          'projectnr': 'P000-000',
          'disabled': '0'}
         '''
+        first_page = self._get_projects_page(1, limit)
+        pages = [first_page['rows']]
+        total = first_page.get('total')
+        if total is not None:
+            # The number of pages is known, so they can be fetched
+            # at the same time
+            page_count = (int(total) + limit - 1) // limit
+            if page_count > 1:
+                # Not clone(), which would load the project list
+                copies = [self._copy() for _ in range(min(jobs, page_count - 1))]
+                try:
+                    pages.extend(httputils.map_concurrently(
+                        lambda session, page: session._get_projects_page(page, limit)['rows'],
+                        copies, list(range(2, page_count + 1))))
+                finally:
+                    for session in copies:
+                        self.close_clone(session)
+        else:
+            # Keep going until a page is not full
+            page = 1
+            seen_ids = {p['id'] for p in pages[0]}
+            while len(pages[-1]) == limit:
+                page += 1
+                rows = self._get_projects_page(page, limit)['rows']
+                if not rows or rows[0]['id'] in seen_ids:
+                    # Paging is not supported. We already have everything.
+                    break
+                seen_ids.update(p['id'] for p in rows)
+                pages.append(rows)
+
+        projects = []
+        seen_ids = set()
+        for rows in pages:
+            for p in rows:
+                if p['id'] not in seen_ids:
+                    seen_ids.add(p['id'])
+                    projects.append(p)
+        return projects
+
+    def _get_projects_page(self, page, limit):
         timestamp = str(int(time.time() * 1000)) # Browser cache protection?
         params = {
             'param1': 'mt-get-projects',
             '_dc': timestamp,
             'param2': 'TIME',
             'show_all': '1',
-            'page': '1',
-            'start': '0',
+            'page': str(page),
+            'start': str((page - 1) * limit),
             'limit': str(limit)
         }
         resp = self.session.get(f'{self.baseurl}/cgi/milltime.cgi/mt_data', params=params)
         assert resp.status_code == 200
 
         # Response is rows: [{ 0: {}, 1: {} }]
-        return json.loads(resp.content)["rows"]
+        return json.loads(resp.content)
 
     def get_activities(self, project_id):
         '''
@@ -290,6 +535,9 @@ class Session:
             #"date_begin": today,
             #"date_end": today
         }
-        resp = self.session.post(f'{self.baseurl}/cgi/milltime.cgi/mt_data', data=data)
+        # Nothing in the request depends on the login, so it can be sent again
+        resp = httputils.retry_login_expired(self.session.post,
+                                             f'{self.baseurl}/cgi/milltime.cgi/mt_data',
+                                             data=data)
         assert resp.status_code == 200
         return json.loads(resp.content)["rows"]
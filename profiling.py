@@ -0,0 +1,97 @@
+# Timing of the phases of a run, for finding out where the time goes.
+# Enabled with --profile. When disabled, phase() returns a shared no-op
+# context manager, so the instrumentation can stay in place.
+
+import collections
+import contextlib
+import cProfile
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+enabled = False
+
+_totals = collections.defaultdict(float)
+_counts = collections.Counter()
+_lock = threading.Lock()
+_noop = contextlib.nullcontext()
+
+class _Phase:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        with _lock:
+            _totals[self.name] += elapsed
+            _counts[self.name] += 1
+
+def phase(name):
+    '''Context manager that adds the time spent inside it to the phase.'''
+    if not enabled:
+        return _noop
+    return _Phase(name)
+
+def iterate(name, iterable):
+    '''Adds the time spent producing each item to the phase.'''
+    if not enabled:
+        return iterable
+    return _timed_iter(name, iter(iterable))
+
+def _timed_iter(name, iterator):
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+@contextlib.contextmanager
+def run(dump_file=None):
+    '''
+    Enables the phase timing and logs a breakdown when done. If dump_file
+    is set, the run is also profiled with cProfile and the statistics are
+    saved there, for use with pstats.
+    '''
+    global enabled
+    # Only this run, when several are made by one process
+    with _lock:
+        _totals.clear()
+        _counts.clear()
+    enabled = True
+    profiler = cProfile.Profile() if dump_file else None
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(dump_file)
+        enabled = False
+        log_summary(time.perf_counter() - start)
+        if profiler:
+            logger.info(f'Profile saved to {dump_file}')
+
+def log_summary(wall_time):
+    '''Logs the phases, slowest first.'''
+    with _lock:
+        rows = sorted(((total, name, _counts[name])
+                       for name, total in _totals.items()), reverse=True)
+    # Phases can be nested (e.g. http inside set_day) and run in several
+    # threads, so the percentages do not add up to 100
+    logger.info('Phases:')
+    logger.info(f'{"Phase":24} {"Count":>6} {"Total s":>8} {"Mean ms":>8} {"% of run":>8}')
+    for total, name, count in rows:
+        logger.info(f'{name:24} {count:6} {total:8.3f} {total / count * 1000:8.2f} '
+                    f'{total / wall_time * 100:8.1f}')
+    logger.info(f'Run: {wall_time:.3f} s')
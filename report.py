@@ -18,33 +18,46 @@
 # along with time-reporting.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import bisect
 import calendar
+import contextlib
 from collections import defaultdict
+import concurrent.futures
 from csv import excel_tab
 import datetime
-import gzip
+import hashlib
+import importlib
+import os
 import sys
 import logging
 import json
+import queue
+import zlib
 
 import timereporting
 import config
-import googledrive
+import profiling
+import serve
+import csvmapping
 import timerec
-import millnet
-import flexhrm
-import xledger
+import uploadledger
 
-logging.basicConfig(stream=sys.stdout, level=logging.INFO,
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format=LOG_FORMAT)
 logger = logging.getLogger('report')
 
-def parse_args():
+# Backend sessions kept logged in by "serve", by backend name. None when
+# each command opens its own.
+warm_sessions = None
+
+def build_parser():
     arg_parser = argparse.ArgumentParser()
     arg_subparsers = arg_parser.add_subparsers(dest='module', required=True)
 
     arg_parser.add_argument('-v', '--verbose', action='store_true',
                             help='Verbose output')
+    arg_parser.add_argument('--client', action='store_true',
+                            help='Run the command in the server started with "serve"')
 
     parser_millnet = arg_subparsers.add_parser('millnet')
     millnet_subparsers = parser_millnet.add_subparsers(dest='command',
@@ -53,13 +66,25 @@ def parse_args():
     parser_millnet_report = millnet_subparsers.add_parser('report')
     parser_millnet_report.add_argument('-n', '--dry-run', action='store_true',
                                help="Don't upload hours to Millnet")
+    parser_millnet_report.add_argument('-f', '--force', action='store_true',
+                               help='Upload also days that are unchanged since the last upload')
+    parser_millnet_report.add_argument('--jobs', type=int, default=1,
+                               help='Number of days to upload concurrently')
+    parser_millnet_report.add_argument('--profile', action='store_true',
+                               help='Log the time spent in each phase of the run')
+    parser_millnet_report.add_argument('--profile-dump', metavar='FILE',
+                               help='Also save cProfile statistics of the main thread to FILE (implies --profile)')
     parser_millnet_report.add_argument('range',
                                help='Date range. YYMMDD-YYMMDD for range, YYMM for a full month, YYMMDD for one day')
-    parser_millnet_report.set_defaults(func=run_report, mod=millnet)
+    parser_millnet_report.set_defaults(func=run_report, mod='millnet')
 
     parser_millnet_dump = millnet_subparsers.add_parser('dump-tasks')
     parser_millnet_dump.set_defaults(func=run_millnet_dump)
 
+    parser_millnet_refresh = millnet_subparsers.add_parser('refresh-catalog',
+                               help='Fetch the project and activity lists again')
+    parser_millnet_refresh.set_defaults(func=run_millnet_refresh_catalog)
+
     parser_timerec = arg_subparsers.add_parser('timerec')
     timerec_subparsers = parser_timerec.add_subparsers(dest='command',
                                                        required=True)
@@ -78,11 +103,19 @@ def parse_args():
     parser_flexhrm_find_company.add_argument('name')
 
     parser_flexhrm_report = flexhrm_subparsers.add_parser('report')
-    parser_flexhrm_report.set_defaults(func=run_report, mod=flexhrm, insert_lunch=True)
+    parser_flexhrm_report.set_defaults(func=run_report, mod='flexhrm', insert_lunch=True)
     parser_flexhrm_report.add_argument('-n', '--dry-run', action='store_true',
                                        help="Don't upload hours to FlexHRM")
     parser_flexhrm_report.add_argument('-j', '--json', action='store_true',
                                        help="Dump data, for example for Javascript consumption")
+    parser_flexhrm_report.add_argument('-f', '--force', action='store_true',
+                               help='Upload also days that are unchanged since the last upload')
+    parser_flexhrm_report.add_argument('--jobs', type=int, default=1,
+                               help='Number of days to upload concurrently')
+    parser_flexhrm_report.add_argument('--profile', action='store_true',
+                               help='Log the time spent in each phase of the run')
+    parser_flexhrm_report.add_argument('--profile-dump', metavar='FILE',
+                               help='Also save cProfile statistics of the main thread to FILE (implies --profile)')
     parser_flexhrm_report.add_argument('range',
                                        help='Date range. YYMMDD-YYMMDD for range, YYMM for a full month, YYMMDD for one day')
 
@@ -93,39 +126,225 @@ def parse_args():
     parser_xledger_report = xledger_subparsers.add_parser('report')
     parser_xledger_report.add_argument('-n', '--dry-run', action='store_true',
                                help="Don't upload hours to Xledger")
+    parser_xledger_report.add_argument('-f', '--force', action='store_true',
+                               help='Upload also days that are unchanged since the last upload')
+    parser_xledger_report.add_argument('--jobs', type=int, default=1,
+                               help='Number of days to upload concurrently')
+    parser_xledger_report.add_argument('--profile', action='store_true',
+                               help='Log the time spent in each phase of the run')
+    parser_xledger_report.add_argument('--profile-dump', metavar='FILE',
+                               help='Also save cProfile statistics of the main thread to FILE (implies --profile)')
     parser_xledger_report.add_argument('range',
                                help='Date range. YYMMDD-YYMMDD for range, YYMM for a full month, YYMMDD for one day')
-    parser_xledger_report.set_defaults(func=run_report, mod=xledger)
+    parser_xledger_report.set_defaults(func=run_report, mod='xledger')
+
+    parser_xledger_refresh = xledger_subparsers.add_parser('refresh-catalog',
+                               help='Fetch the project and activity lists again')
+    parser_xledger_refresh.set_defaults(func=run_xledger_refresh_catalog)
+
+    parser_summarize = arg_subparsers.add_parser('summarize',
+                               help='Sum up hours per period and account')
+    parser_summarize.add_argument('-s', '--system', default=timerec.name,
+                               help='Accounting system to sum accounts for. Default: timerec')
+    parser_summarize.add_argument('-p', '--period', choices=('day', 'week', 'month', 'year', 'total'),
+                               default='month',
+                               help='Period to sum hours over. Default: month')
+    parser_summarize.add_argument('-f', '--format', choices=('csv', 'json'),
+                               default='csv',
+                               help='Output format. Default: csv')
+    parser_summarize.add_argument('-o', '--output',
+                               help='Output file. Default: standard output')
+    parser_summarize.add_argument('range',
+                               help='Date range. YYMMDD-YYMMDD for range, YYMM for a full month, YYMMDD for one day')
+    parser_summarize.set_defaults(func=run_summarize)
 
-    args = arg_parser.parse_args()
+    parser_serve = arg_subparsers.add_parser('serve',
+                               help='Keep backend logins and caches warm, and run commands sent with --client')
+    parser_serve.add_argument('--socket',
+                               help=f'Unix socket to listen on. Default: serve_socket in config, or {serve.DEFAULT_SOCKET}')
+    parser_serve.set_defaults(func=run_serve)
+
+    return arg_parser
+
+def parse_args():
+    args = build_parser().parse_args()
+
+    if args.client:
+        argv = [arg for arg in sys.argv[1:] if arg != '--client']
+        sys.exit(serve.forward(serve_socket(), argv))
 
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.INFO)
     
-    args.func(args)
+    run_args(args)
+
+def run_args(args):
+    if getattr(args, 'profile', False) or getattr(args, 'profile_dump', None):
+        with profiling.run(args.profile_dump):
+            args.func(args)
+    else:
+        args.func(args)
+
+def serve_socket(args=None):
+    if args and args.socket:
+        return args.socket
+    return getattr(config, 'serve_socket', serve.DEFAULT_SOCKET)
+
+def run_serve(args):
+    global warm_sessions
+    warm_sessions = {}
+    try:
+        serve.serve(serve_socket(args), run_command)
+    finally:
+        for session in warm_sessions.values():
+            session.__exit__(None, None, None)
+
+def run_command(argv, out):
+    '''
+    Runs a command for "serve", writing its output and log to out.
+    Returns the exit code.
+    '''
+    global account_index
+    # Imported by the backends already
+    import httputils
+
+    root_logger = logging.getLogger()
+    level = root_logger.level
+    handler = logging.StreamHandler(out)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root_logger.addHandler(handler)
+    try:
+        if csvmapping.forget_changed_mapping():
+            logger.info('Mapping file changed')
+            account_index = None
+        httputils.clear_requests()
+
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+            args = build_parser().parse_args(argv)
+            if args.func is run_serve or args.client:
+                raise Exception('Not a command for the server')
+            root_logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+            run_args(args)
+        return 0
+    except SystemExit as e:
+        # From argparse, e.g. for --help or bad arguments
+        if e.code is None:
+            return 0
+        return e.code if isinstance(e.code, int) else 1
+    except Exception:
+        logger.exception('Command failed')
+        return 1
+    finally:
+        root_logger.removeHandler(handler)
+        root_logger.setLevel(level)
+
+@contextlib.contextmanager
+def backend_session(target):
+    '''
+    Opens a Session of the backend module. When serving, the session is
+    kept logged in for the next command.
+    '''
+    if warm_sessions is None:
+        with target.Session() as session:
+            yield session
+        return
+
+    session = warm_sessions.get(target.name)
+    if session is None:
+        session = target.Session().__enter__()
+        warm_sessions[target.name] = session
+    try:
+        yield session
+    finally:
+        # Save cookies and caches, like when closing a session
+        session.__exit__(None, None, None)
 
 def run_timerec_fetch(args):
     logger.info("Downloading Time Recording database...")
-    download_timerec_db()
-    logger.info("Done")
+    if download_timerec_db():
+        logger.info("Done")
+    else:
+        logger.info("Up to date")
 
 def download_timerec_db():
-    temp_db_filename = 'timerec_temp.gz'
-    googledrive.download_file(config.google_fileid, temp_db_filename)
-    with gzip.open(temp_db_filename) as gzfile:
-        with open(config.timerec_db_filename, 'wb') as unpacked_file:
-            unpacked_file.write(gzfile.read())
+    '''
+    Downloads the database, unless it is unchanged since the last download.
+
+    Returns False if the database was up to date.
+    '''
+    # What we know about the last download
+    fetch_info_filename = config.timerec_db_filename + '.fetch.json'
+    try:
+        with open(fetch_info_filename) as f:
+            fetch_info = json.load(f)
+    except FileNotFoundError:
+        fetch_info = {}
+    if not os.path.exists(config.timerec_db_filename):
+        fetch_info = {}
+
+    headers = {}
+    if fetch_info.get('etag'):
+        headers['If-None-Match'] = fetch_info['etag']
+    if fetch_info.get('last_modified'):
+        headers['If-Modified-Since'] = fetch_info['last_modified']
+
+    # Unpack while downloading, into a temporary file that replaces the
+    # database only when complete
+    temp_db_filename = config.timerec_db_filename + '.tmp'
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) # gzip header
+    content_hash = hashlib.sha256()
+    import googledrive
+    with googledrive.open_file(config.google_fileid, headers) as resp:
+        if resp.status_code == 304:
+            return False
+        new_fetch_info = { 'etag': resp.headers.get('ETag'),
+                           'last_modified': resp.headers.get('Last-Modified'),
+                           'size': resp.headers.get('Content-Length') }
+        # In case the server ignores the conditional headers
+        if fetch_info and (
+                (new_fetch_info['etag'] and new_fetch_info['etag'] == fetch_info.get('etag')) or
+                (new_fetch_info['last_modified'] and new_fetch_info['size'] and
+                 new_fetch_info['last_modified'] == fetch_info.get('last_modified') and
+                 new_fetch_info['size'] == fetch_info.get('size'))):
+            return False
+
+        try:
+            with open(temp_db_filename, 'wb') as unpacked_file:
+                for chunk in resp.iter_content(googledrive.CHUNK_SIZE):
+                    content_hash.update(chunk)
+                    unpacked_file.write(decompressor.decompress(chunk))
+                unpacked_file.write(decompressor.flush())
+            if not decompressor.eof:
+                raise Exception('Time Recording database download is incomplete')
+            new_fetch_info['sha256'] = content_hash.hexdigest()
+            if new_fetch_info['sha256'] == fetch_info.get('sha256'):
+                # Same content. Keep the old file, and its timestamp.
+                os.remove(temp_db_filename)
+                changed = False
+            else:
+                os.replace(temp_db_filename, config.timerec_db_filename)
+                changed = True
+        except:
+            if os.path.exists(temp_db_filename):
+                os.remove(temp_db_filename)
+            raise
+
+    with open(fetch_info_filename, 'w') as f:
+        json.dump(new_fetch_info, f)
+    return changed
 
 # Get a table of
 # project_id, project name, activity_id, activity name
 def fetch_millnet_user_activities(millnet_session):
     user_activities = []
-    millnet_projects = millnet_session.get_projects()
+    millnet_projects = millnet_session.get_cached_projects()
+    millnet_session.prefetch_activities([p['id'] for p in millnet_projects
+                                         if p['groupname'] == 'Medlem'])
     for p in millnet_projects:
         if p['groupname'] == 'Medlem':
-            activities = millnet_session.get_activities(p['id'])
+            activities = millnet_session.get_cached_activities(p['id'])
             for a in activities:
                 user_activities.append((p['id'], p['value'],
                                         a['ActivityId'], a['Name']))
@@ -158,7 +377,8 @@ def parse_report_range(range_str):
     return begin_date, end_date
 
 def run_report(args):
-    target = args.mod
+    # Only load the backend that is used
+    target = importlib.import_module(args.mod)
     insert_lunch = hasattr(args, 'insert_lunch') and args.insert_lunch
 
     begin_date, end_date = parse_report_range(args.range)
@@ -186,56 +406,193 @@ def run_report(args):
             dump_days.append(dump_day)
         print(json.dumps({'system': target.name, 'days': dump_days, 'len': len(dump_days)}))
     else:
-        with target.Session() as m:
+        with uploadledger.Ledger() as ledger:
+            if not args.force:
+                unchanged = [date for date, entries in days
+                             if ledger.is_uploaded(target.name, date, entries)]
+                if unchanged:
+                    logger.info(f'Skipping {len(unchanged)} days that are unchanged since the last upload')
+                    days = [(date, entries) for date, entries in days
+                            if date not in unchanged]
+            if not days:
+                logger.info("Nothing to report")
+                return
+            upload_report(args, target, days, ledger)
+
+def upload_report(args, target, days, ledger):
+    try:
+        with backend_session(target) as m:
             logger.info("Reporting...")
             if args.dry_run:
                 logger.info("DRY RUN")
-            for date, entries in days:
+            if hasattr(m, 'prefetch_accounts') and not args.dry_run:
+                # Resolve each account once, instead of on the first day
+                # it is used
+                m.prefetch_accounts(entry.account[target.name]
+                                    for _, entries in days
+                                    for entry in entries)
+            def saved(date, entries):
                 logger.info(date)
-                if not args.dry_run:
-                    m.set_day(date, entries)
+                ledger.mark_uploaded(target.name, date, entries)
+
+            if args.dry_run:
+                for date, _ in days:
+                    logger.info(date)
+            elif args.jobs > 1:
+                units = upload_units(m, days)
+                failures = upload_concurrently(m, units, args.jobs, saved)
+                if failures:
+                    for unsaved_days, e in failures:
+                        logger.error(f'{unsaved_days[0][0]}: {e!r}')
+                    failed_days = sum(len(unsaved_days) for unsaved_days, _ in failures)
+                    raise Exception(f'Failed to report {failed_days} of {len(days)} days')
+            else:
+                for unit in upload_units(m, days):
+                    upload_unit(m, unit, saved)
             logger.info("Done")
+    finally:
+        # Also after a failure, when the numbers can tell why. Imported
+        # by the backends already.
+        import httputils
+        httputils.log_summary()
+
+def upload_units(session, days):
+    '''
+    Groups the days into lists that are uploaded with one call. Backends
+    with set_days() get the days of each week together, others one day
+    at a time.
+    '''
+    if not hasattr(session, 'set_days'):
+        return [[day] for day in days]
+    weeks = {}
+    for date, entries in days:
+        week_start = date - datetime.timedelta(days=date.weekday())
+        weeks.setdefault(week_start, []).append((date, entries))
+    return list(weeks.values())
+
+def upload_unit(session, unit, saved):
+    '''
+    Uploads the days of a unit from upload_units(). saved(date, entries) is
+    called for each day as soon as it has been saved.
+    '''
+    if hasattr(session, 'set_days'):
+        with profiling.phase('set_days'):
+            session.set_days(unit, saved)
+    else:
+        for date, entries in unit:
+            with profiling.phase('set_day'):
+                session.set_day(date, entries)
+            saved(date, entries)
+
+def upload_concurrently(session, units, jobs, saved):
+    '''
+    Uploads the units (see upload_units()) using a pool of worker sessions.
+    saved is called from the worker threads.
+
+    Returns a list of (days, exception) for the units that failed, where
+    days are the days of the unit that were not saved.
+    '''
+    clones = [session.clone() for _ in range(jobs)]
+    workers = queue.Queue()
+    for clone in clones:
+        workers.put(clone)
+    saved_dates = set()
+
+    def upload(unit):
+        def saved_day(date, entries):
+            saved(date, entries)
+            saved_dates.add(date)
+
+        worker = workers.get()
+        try:
+            upload_unit(worker, unit, saved_day)
+        finally:
+            workers.put(worker)
+
+    failures = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = { executor.submit(upload, unit): unit for unit in units }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    unit = futures[future]
+                    failures.append(([day for day in unit
+                                      if day[0] not in saved_dates], e))
+    finally:
+        # Take back their state, so that session saves it
+        for clone in clones:
+            session.close_clone(clone)
+    failures.sort(key=lambda failure: failure[0][0][0])
+    return failures
+
+def run_summarize(args):
+    # NumPy is only needed for this command
+    import summary
+
+    begin_date, end_date = parse_report_range(args.range)
+    with timerec.Session() as source:
+        entries = summary.load_entries(source.conn, begin_date, end_date)
+    sums = summary.summarize(entries, account_mapping(), args.system,
+                             args.period)
+
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        if args.format == 'json':
+            summary.write_json(sums, args.system, args.period, out)
+        else:
+            summary.write_csv(sums, out)
+    finally:
+        if args.output:
+            out.close()
 
 def collect_days(source_mod, target_mod, begin_date, end_date, insert_lunch):
     days = []
-    one_day = datetime.timedelta(days=1)
-    current_date = begin_date
     with source_mod.Session() as source:
-        while current_date <= end_date:
-            entries = source.get_day(current_date)
-            target_entries = [e for e in entries
-                                if convert_entry(e, source_mod.name, target_mod.name)]
+        for current_date, entries in profiling.iterate('read entries',
+                                                       source.get_range(begin_date, end_date)):
+            with profiling.phase('convert_entry'):
+                target_entries = [e for e in entries
+                                    if convert_entry(e, source_mod.name, target_mod.name)]
             if target_entries:
                 if insert_lunch and config.detect_lunch:
-                    lunch = detect_lunch(target_entries, current_date)
-                    convert_entry(lunch, 'generic', target_mod.name)
-                    # TODO: Define __lt__ and use bisect.insort() to keep entries sorted
-                    target_entries.append(lunch)
+                    with profiling.phase('detect_lunch'):
+                        lunch = detect_lunch(target_entries, current_date)
+                        convert_entry(lunch, 'generic', target_mod.name)
+                        bisect.insort(target_entries, lunch)
                 days.append((current_date, target_entries))
-            current_date += one_day
     return days
 
 def run_millnet_dump(args):
-    with millnet.Session(config.millnet_baseurl,
-                         config.millnet_username,
-                         config.millnet_ask_password) as m:
+    import millnet
+    with backend_session(millnet) as m:
         for row in fetch_millnet_user_activities(m):
             print((row[1], row[0], row[3], row[2]))
 
+def run_millnet_refresh_catalog(args):
+    import millnet
+    with backend_session(millnet) as m:
+        m.refresh_catalog()
+        logger.info(f'Cached {len(m.project_list_cache)} projects')
+
 def run_flexhrm_find_project(args):
-    with flexhrm.Session(config.flexhrm_baseurl, config.flexhrm_username,
-                         config.flexhrm_ask_password) as flex:
+    import flexhrm
+    with backend_session(flexhrm) as flex:
         for label, guid in flex.find_project(args.name):
             print(guid, label)
 
 def run_flexhrm_find_company(args):
-    with flexhrm.Session(config.flexhrm_baseurl, config.flexhrm_username,
-                         config.flexhrm_ask_password) as flex:
+    import flexhrm
+    with backend_session(flexhrm) as flex:
         for label, guid in flex.find_company(args.name):
             print(guid, label)
 
-def run_xledger_report(args):
-    run_report(args, xledger)
+def run_xledger_refresh_catalog(args):
+    import xledger
+    with backend_session(xledger) as x:
+        x.refresh_catalog()
+        logger.info(f'Cached {len(x.project_list_cache)} projects')
 
 def detect_lunch(entries, current_date):
     # This function assumes that entries are sorted
@@ -263,19 +620,46 @@ def convert_entry(entry, from_system, to_system):
 
     Returns True if the entry should be counted in the to_system.
     '''
-    index = config.account_mapping[from_system].index(entry.account[from_system])
+    if account_index is None:
+        check_mappings()
+    try:
+        index = account_index[from_system][entry.account[from_system]]
+    except KeyError:
+        raise Exception(f'Could not find "{from_system}" account in mapping: {entry.account[from_system]}\n'
+                        'Check your config.')
     try:
-        value = config.account_mapping[to_system][index]
+        value = account_mapping()[to_system][index]
     except IndexError:
         raise Exception(f'Could not convert entry from "{from_system}" to "{to_system}": {entry.account[from_system]}\n'
                         'Check your config.')
     entry.account[to_system] = value
     return value is not None
 
+def account_mapping():
+    # Older configs load the mapping themselves. Those that import it from
+    # csvmapping keep the one that was loaded then, so use the current one.
+    mapping = getattr(config, 'account_mapping', None)
+    if mapping is not None and not csvmapping.is_file_mapping(mapping):
+        return mapping
+    return csvmapping.get_account_mapping()
+
+# Built by check_mappings(), on the first conversion
+account_index = None
+
 def check_mappings():
     # TODO: Check that all mapping lists have equal length
     # Only when using them?
-    pass
-
-check_mappings()
-parse_args()
+    global account_index
+    account_index, duplicate_accounts = csvmapping.index_accounts(account_mapping())
+
+    # Target systems can share accounts, but a source account must
+    # identify one row
+    for system in (timerec.name, 'generic'):
+        for account, rows in duplicate_accounts.get(system, []):
+            # Report row numbers as in the CSV file, including the header
+            logger.warning(f'Duplicate "{system}" account in mapping on rows '
+                           f'{", ".join(str(row + 2) for row in rows)}: {account}. '
+                           'Using the first row.')
+
+if __name__ == '__main__':
+    parse_args()
@@ -0,0 +1,117 @@
+# This file is part of time-reporting.
+#
+# Copyright (C) 2022  Thomas Axelsson
+#
+# time-reporting is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# time-reporting is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with time-reporting.  If not, see <https://www.gnu.org/licenses/>.
+
+# Runs report.py commands in a long-running process, so that logins and
+# caches stay warm between commands. A client sends a command line over a
+# Unix socket, as one JSON line, and gets the output back as JSON lines:
+#   {"output": "..."} for each write, then {"exit_code": 0}
+
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+
+logger = logging.getLogger(__name__)
+
+# Override with serve_socket in config
+DEFAULT_SOCKET = 'report.sock'
+
+class ClientWriter:
+    '''File-like object that sends what is written to the client.'''
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text):
+        if text:
+            _send(self.wfile, { 'output': text })
+        return len(text)
+
+    def flush(self):
+        self.wfile.flush()
+
+def _send(wfile, message):
+    wfile.write(json.dumps(message).encode() + b'\n')
+    wfile.flush()
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        logger.info('Running: %s', ' '.join(request['argv']))
+        exit_code = self.server.run_command(request['argv'],
+                                            ClientWriter(self.wfile))
+        _send(self.wfile, { 'exit_code': exit_code })
+
+def _is_listening(socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(socket_path)
+            return True
+        except (ConnectionRefusedError, FileNotFoundError):
+            return False
+
+def serve(socket_path, run_command):
+    '''
+    Serves commands one at a time, until interrupted. run_command(argv, out)
+    runs a command, writing its output to out, and returns the exit code.
+    '''
+    if os.path.exists(socket_path):
+        if _is_listening(socket_path):
+            raise Exception(f'Already serving on {socket_path}')
+        # Left by a server that did not shut down cleanly
+        os.unlink(socket_path)
+
+    # Only the user may connect, as commands act on the user's accounts
+    old_umask = os.umask(0o177)
+    try:
+        server = socketserver.UnixStreamServer(socket_path, _Handler)
+    finally:
+        os.umask(old_umask)
+    server.run_command = run_command
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+    # Shut down cleanly on kill as well, so that the sessions are saved
+    signal.signal(signal.SIGTERM, stop)
+
+    logger.info(f'Serving on {socket_path}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+def forward(socket_path, argv, out=sys.stdout):
+    '''Runs a command in the server. Returns its exit code.'''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            raise Exception(f'No server on {socket_path}. Start one with: ./report.py serve')
+        with s.makefile('rwb') as f:
+            _send(f, { 'argv': argv })
+            for line in f:
+                message = json.loads(line)
+                if 'exit_code' in message:
+                    return message['exit_code']
+                out.write(message['output'])
+                out.flush()
+    raise Exception('The server closed the connection')
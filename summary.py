@@ -0,0 +1,176 @@
+# This file is part of time-reporting.
+#
+# Copyright (C) 2022  Thomas Axelsson
+#
+# time-reporting is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# time-reporting is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with time-reporting.  If not, see <https://www.gnu.org/licenses/>.
+
+# Hour totals over long periods, e.g. for checking invoices. The stamps
+# are loaded into NumPy arrays, so that years of data can be summed without
+# creating an Entry per stamp.
+
+import csv
+import datetime
+import json
+
+import numpy as np
+
+import csvmapping
+import timerec
+
+class Entries:
+    '''Column arrays with one element per timerec entry.'''
+    def __init__(self, dates, durations, account_ids, accounts):
+        # datetime64[D]
+        self.dates = dates
+        # Seconds
+        self.durations = durations
+        # Index into accounts
+        self.account_ids = account_ids
+        # timerec accounts, (customer, category)
+        self.accounts = accounts
+
+def load_entries(conn, begin_date, end_date):
+    '''
+    Loads all entries in the inclusive date range from the Time Recording
+    database.
+    '''
+    begin_str = begin_date.strftime("%Y-%m-%d 00:00:00")
+    end_str = end_date.strftime("%Y-%m-%d 00:00:00")
+    c = conn.cursor()
+    c.execute("select asofdate, stamp_date_str, check_action, customer, t_category_1.name from T_STAMP_3 left outer join T_CATEGORY_1 on T_CATEGORY_1.id = T_STAMP_3.category_id where asofdate >= ? and asofdate <= ? order by asofdate asc, stamp_date_str asc, check_action desc", (begin_str, end_str))
+    rows = c.fetchall()
+
+    account_codes = {}
+    dates = np.array([row[0][:10] for row in rows], dtype='datetime64[D]')
+    stamps = np.array([row[1] for row in rows], dtype='datetime64[s]')
+    actions = np.array([row[2] for row in rows], dtype=np.int8)
+    account_ids = np.fromiter((account_codes.setdefault((row[3], row[4]),
+                                                        len(account_codes))
+                               for row in rows),
+                              dtype=np.int32, count=len(rows))
+
+    # A repeated action is ignored, like in timerec.Session.get_range()
+    new_day = np.ones(len(rows), dtype=bool)
+    new_day[1:] = dates[1:] != dates[:-1]
+    repeated = np.zeros(len(rows), dtype=bool)
+    repeated[1:] = actions[1:] == actions[:-1]
+    keep = new_day | ~repeated
+    dates = dates[keep]
+    stamps = stamps[keep]
+    actions = actions[keep]
+    account_ids = account_ids[keep]
+
+    # Every check-in must be followed by a check-out on the same day
+    check_ins = np.flatnonzero(actions == timerec.CHECK_ACTION_IN)
+    check_outs = check_ins + 1
+    complete = check_outs < len(actions)
+    complete[complete] = ((actions[check_outs[complete]] == timerec.CHECK_ACTION_OUT) &
+                          (dates[check_outs[complete]] == dates[check_ins[complete]]))
+    if not complete.all():
+        index = check_ins[~complete][0]
+        raise Exception(f'Non-completed entry: {dates[index]} {stamps[index]}')
+
+    durations = (stamps[check_outs] - stamps[check_ins]).astype(np.int64)
+    accounts = [None] * len(account_codes)
+    for account, code in account_codes.items():
+        accounts[code] = account
+    return Entries(dates[check_ins], durations, account_ids[check_ins],
+                   accounts)
+
+def period_starts(dates, period):
+    '''Returns the first day of the period that each date belongs to.'''
+    if period == 'day':
+        return dates
+    elif period == 'week':
+        # 1970-01-01 was a Thursday. Weeks start on Monday.
+        days = dates.astype(np.int64)
+        return (days - (days + 3) % 7).astype('datetime64[D]')
+    elif period == 'month':
+        return dates.astype('datetime64[M]').astype('datetime64[D]')
+    elif period == 'year':
+        return dates.astype('datetime64[Y]').astype('datetime64[D]')
+    elif period == 'total':
+        return np.zeros(len(dates), dtype='datetime64[D]')
+    raise Exception(f'Unknown period: {period}')
+
+def summarize(entries, account_mapping, system, period):
+    '''
+    Sums the entries per period and per account of the given system.
+
+    Returns a sorted list of (period start, account, seconds). The period
+    start is None for the 'total' period.
+    '''
+    account_index, _ = csvmapping.index_accounts(account_mapping)
+
+    # Translate each timerec account to an account ID in the target system,
+    # or -1 when it is not reported there
+    system_accounts = []
+    system_account_codes = {}
+    translation = np.empty(len(entries.accounts), dtype=np.int32)
+    for i, account in enumerate(entries.accounts):
+        if system == timerec.name:
+            value = account
+        else:
+            try:
+                row = account_index[timerec.name][account]
+            except KeyError:
+                raise Exception(f'Could not find "{timerec.name}" account in mapping: {account}\n'
+                                'Check your config.')
+            try:
+                value = account_mapping[system][row]
+            except IndexError:
+                raise Exception(f'Could not convert entry from "{timerec.name}" to "{system}": {account}\n'
+                                'Check your config.')
+        if value is None:
+            translation[i] = -1
+        else:
+            if value not in system_account_codes:
+                system_account_codes[value] = len(system_accounts)
+                system_accounts.append(value)
+            translation[i] = system_account_codes[value]
+
+    account_ids = translation[entries.account_ids]
+    counted = account_ids >= 0
+    starts = period_starts(entries.dates[counted], period)
+    keys = np.stack((starts.astype(np.int64), account_ids[counted]), axis=1)
+    if len(keys) == 0:
+        return []
+    unique_keys, groups = np.unique(keys, axis=0, return_inverse=True)
+    seconds = np.bincount(groups.ravel(), weights=entries.durations[counted],
+                          minlength=len(unique_keys))
+
+    sums = []
+    for (start, account_id), group_seconds in zip(unique_keys, seconds):
+        start = None if period == 'total' else np.datetime64(int(start), 'D').item()
+        sums.append((start, system_accounts[account_id], int(group_seconds)))
+    sums.sort(key=lambda s: (s[0] or datetime.date.min,
+                             tuple(a or '' for a in s[1])))
+    return sums
+
+def write_csv(sums, out):
+    writer = csv.writer(out)
+    writer.writerow(['period', 'account', 'hours'])
+    for start, account, seconds in sums:
+        writer.writerow([start or '', ' / '.join(a or '' for a in account),
+                         round(seconds / 3600, 2)])
+
+def write_json(sums, system, period, out):
+    json.dump({ 'system': system,
+                'period': period,
+                'sums': [{ 'period': str(start) if start else None,
+                           'account': account,
+                           'hours': round(seconds / 3600, 2) }
+                         for start, account, seconds in sums] },
+              out)
+    out.write('\n')
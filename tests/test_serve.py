@@ -0,0 +1,75 @@
+# Run from the repository root:
+#   python -m pytest tests
+# or
+#   python -m unittest discover tests
+
+import io
+import json
+import os
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+try:
+    import config
+except ImportError:
+    config = types.ModuleType('config')
+    sys.modules['config'] = config
+
+import csvmapping
+import report
+from benchmarks import timerecdb
+
+MAPPING_HEADER = 'generic,timerec-customer,timerec-project,flexhrm-code,flexhrm-company,flexhrm-project\n'
+
+class RunCommandTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.mapping_file = os.path.join(tmp_dir.name, 'mapping.csv')
+        db_filename = os.path.join(tmp_dir.name, 'timerec.db')
+        timerecdb.generate(db_filename, years=7 / 365, entries_per_day=2,
+                           categories=2)
+
+        for patcher in (mock.patch.object(csvmapping, 'MAPPING_FILE', self.mapping_file),
+                        mock.patch.object(csvmapping, '_account_mapping', None),
+                        mock.patch.object(report, 'account_index', None),
+                        mock.patch.multiple(config, create=True,
+                                            timerec_db_filename=db_filename,
+                                            detect_lunch=False)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write_mapping(self, project, mtime):
+        with open(self.mapping_file, 'w', newline='') as f:
+            f.write(MAPPING_HEADER)
+            f.write('LUNCH,,,Lunch,,\n')
+            for i in range(2):
+                customer, category = timerecdb.category_account(i)
+                f.write(f',{customer},{category},Normal,,{project}\n')
+        # Whole seconds apart, whatever the file system's resolution
+        os.utime(self.mapping_file, (mtime, mtime))
+
+    def reported_projects(self):
+        out = io.StringIO()
+        exit_code = report.run_command(['flexhrm', 'report', '-j', '200101-200103'],
+                                       out)
+        self.assertEqual(exit_code, 0, out.getvalue())
+        dump = next(json.loads(line) for line in out.getvalue().splitlines()
+                    if line.startswith('{'))
+        return {entry['account'][2]
+                for day in dump['days'] for entry in day['entries']}
+
+    def test_changed_mapping_is_used(self):
+        self.write_mapping('Project A', 1_000_000_000)
+        # As in configs that do "from csvmapping import account_mapping"
+        with mock.patch.object(config, 'account_mapping',
+                               csvmapping.account_mapping, create=True):
+            self.assertEqual(self.reported_projects(), {'Project A'})
+            self.write_mapping('Project B', 1_000_000_001)
+            self.assertEqual(self.reported_projects(), {'Project B'})
+
+if __name__ == '__main__':
+    unittest.main()
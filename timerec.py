@@ -39,23 +39,48 @@ class Session:
         self.conn.close()
 
     def get_day(self, date):
-        date_str = date.strftime("%Y-%m-%d 00:00:00")
+        for _, entries in self.get_range(date, date):
+            return entries
+        return []
+
+    def get_range(self, begin_date, end_date):
+        '''
+        Yields (date, entries) for each day in the inclusive range that
+        has any stamps. Days without stamps are skipped.
+
+        All stamps are read with one query, so the cost depends on the
+        number of stamps rather than the number of days.
+        '''
+        begin_str = begin_date.strftime("%Y-%m-%d 00:00:00")
+        end_str = end_date.strftime("%Y-%m-%d 00:00:00")
         c = self.conn.cursor()
-        c.execute("select stamp_date_str, check_action, customer, t_category_1.name, comment from T_STAMP_3 left outer join T_CATEGORY_1 on T_CATEGORY_1.id = T_STAMP_3.category_id where asofdate == ? order by stamp_date_str asc, check_action desc", (date_str,))
+        c.execute("select asofdate, stamp_date_str, check_action, customer, t_category_1.name, comment from T_STAMP_3 left outer join T_CATEGORY_1 on T_CATEGORY_1.id = T_STAMP_3.category_id where asofdate >= ? and asofdate <= ? order by asofdate asc, stamp_date_str asc, check_action desc", (begin_str, end_str))
 
+        date_str = None
+        date = None
         entries = []
         last_action = None
-        row = c.fetchone()
         last_row = None
         current_entry = None
-        while row:
+        for row in c:
             #print(row)
+            if row[0] != date_str:
+                if date_str is not None:
+                    self._check_completed(date, last_action, current_entry)
+                    yield date, entries
+                date_str = row[0]
+                date = datetime.date.fromisoformat(date_str[:10])
+                entries = []
+                last_action = None
+                last_row = None
+                current_entry = None
+
             # Parse stamp
-            dt = datetime.datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S")
-            action = row[1]
-            customer = row[2]
-            category = row[3]
-            comment = row[4]
+            dt = datetime.datetime.fromisoformat(row[1])
+            action = row[2]
+            customer = row[3]
+            category = row[4]
+            comment = row[5]
 
             if action == last_action:
                 print("Same action twice!")
@@ -73,10 +98,12 @@ class Session:
 
             last_action = action
             last_row = row
-            row = c.fetchone()
 
+        if date_str is not None:
+            self._check_completed(date, last_action, current_entry)
+            yield date, entries
+
+    def _check_completed(self, date, last_action, current_entry):
         if last_action != CHECK_ACTION_OUT and current_entry:
             print("Last action was not check")
             raise Exception(f"Non-completed entry: {date} {current_entry}")
-
-        return entries 
@@ -30,10 +30,22 @@ class Day:
     def get_total_hours():
         pass
 
+def _seconds(time):
+    return time.hour * 3600 + time.minute * 60 + time.second
+
 class Entry:
+    # Slots, as there can be tens of thousands of entries. Times are also
+    # kept as seconds since midnight, to make sums and comparisons cheap.
+    __slots__ = ('_begin_time', '_end_time', 'begin', 'end', 'duration',
+                 'account', 'comment')
+
     def __init__(self):
-        self.begin_time = None
-        self.end_time = None
+        self._begin_time = None
+        self._end_time = None
+        self.begin = None
+        self.end = None
+        # Seconds, when both begin and end are set
+        self.duration = None
 
         # Different reports will have e.g. one or multiple of company,
         # client and project. If one is consulting, any <project> in
@@ -44,6 +56,35 @@ class Entry:
         
         self.comment = None
 
+    @property
+    def begin_time(self):
+        return self._begin_time
+
+    @begin_time.setter
+    def begin_time(self, time):
+        self._begin_time = time
+        self.begin = _seconds(time) if time is not None else None
+        self._update_duration()
+
+    @property
+    def end_time(self):
+        return self._end_time
+
+    @end_time.setter
+    def end_time(self, time):
+        self._end_time = time
+        self.end = _seconds(time) if time is not None else None
+        self._update_duration()
+
+    def _update_duration(self):
+        if self.begin is not None and self.end is not None:
+            self.duration = self.end - self.begin
+        else:
+            self.duration = None
+
+    def __lt__(self, other):
+        return (self.begin, self.end) < (other.begin, other.end)
+
     def __str__(self):
         return '%s-%s %s %s' % (self.begin_time,
                                 self.end_time,
@@ -60,9 +101,12 @@ def sum_entries(entries, for_system):
     '''Sums the worked time for each account for the given accounting system.
 
     The result is one sum entry for each account.'''
-    sums = defaultdict(datetime.timedelta)
+    seconds = defaultdict(int)
     for entry in entries:
         account = entry.account[for_system]
         if account:
-            sums[entry.account[for_system]] += datetime.datetime.combine(datetime.date.min, entry.end_time) - datetime.datetime.combine(datetime.date.min, entry.begin_time)
+            seconds[account] += entry.duration
+    sums = defaultdict(datetime.timedelta)
+    for account, account_seconds in seconds.items():
+        sums[account] = datetime.timedelta(seconds=account_seconds)
     return sums
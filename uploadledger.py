@@ -0,0 +1,70 @@
+# This file is part of time-reporting.
+#
+# Copyright (C) 2021  Thomas Axelsson
+#
+# time-reporting is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# time-reporting is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with time-reporting.  If not, see <https://www.gnu.org/licenses/>.
+
+# Keeps track of what was last uploaded for each system and day, so that
+# unchanged days can be skipped.
+
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+import config
+
+LEDGER_FILE = 'upload_ledger.db'
+
+def entries_hash(entries, system):
+    '''Hash of everything in the entries that is uploaded to the system.'''
+    content = [(str(entry.begin_time), str(entry.end_time),
+                entry.account[system], entry.comment)
+               for entry in entries]
+    return hashlib.sha256(json.dumps(content).encode()).hexdigest()
+
+class Ledger:
+
+    def __init__(self):
+        # Keep the ledger next to the Time Recording database by default
+        self.filename = getattr(config, 'upload_ledger_filename',
+                                os.path.join(os.path.dirname(config.timerec_db_filename),
+                                             LEDGER_FILE))
+        # Uploads running in several threads mark days as they are saved
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+        self.conn.execute("create table if not exists uploads (system text, date text, hash text, upload_time text, primary key (system, date))")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.conn.close()
+
+    def is_uploaded(self, system, date, entries):
+        '''Returns True if exactly these entries were the last ones uploaded.'''
+        c = self.conn.cursor()
+        c.execute("select hash from uploads where system == ? and date == ?",
+                  (system, date.isoformat()))
+        row = c.fetchone()
+        return row is not None and row[0] == entries_hash(entries, system)
+
+    def mark_uploaded(self, system, date, entries):
+        with self.lock, self.conn:
+            self.conn.execute("insert or replace into uploads values (?, ?, ?, ?)",
+                              (system, date.isoformat(),
+                               entries_hash(entries, system),
+                               datetime.datetime.now().isoformat(timespec='seconds')))
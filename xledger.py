@@ -16,22 +16,28 @@
 # along with time-reporting.  If not, see <https://www.gnu.org/licenses/>.
 
 import bs4
+import copy
 import datetime
-import requests
 import pickle
 import time
 import json
 import logging
+import threading
 import re
 import csv
 
 import config
 import htmlutils
+import httputils
 import timereporting
 
 name = 'xledger'
 
 SESSION_DATA_FILE = 'xledger_data.pickle'
+CATALOG_FILE = 'xledger_catalog.pickle'
+
+# Override with xledger_catalog_max_age in config
+DEFAULT_CATALOG_MAX_AGE = datetime.timedelta(days=7)
 
 logger = logging.getLogger(__name__)
 
@@ -77,18 +83,79 @@ class Session:
 
         self.project_list_cache = None
         self.activity_list_cache = {}
-        self.session = requests.Session()
+        self.catalog_time = None
+        # Lists that were fetched by this session, as opposed to loaded
+        # from the catalog file
+        self.fresh_projects = False
+        self.fresh_activities = set()
+        # When the login was last known to work
+        self.validated_time = None
+        # Shared with the clones, which use the same login
+        self.login_lock = threading.Lock()
+        self.session = self._new_session()
 
         self.load_session_data()
+        self.load_catalog()
 
     def __enter__(self):
-        self.log_in()
+        # A recent login is used without checking it. If it has expired,
+        # the first request ends up on the login page, and we log in then.
+        if httputils.is_fresh(self.validated_time):
+            logger.debug('Using the login from the last run')
+        else:
+            with self.session.login():
+                self.log_in()
+            self.validated_time = datetime.datetime.now()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         # Cannot use  __del__ as Python functions (e.g. open()) are
         # removed at that point...
         self.save_session_data()
+        self.save_catalog()
+
+    def clone(self):
+        '''
+        Returns a Session that shares the login (cookie jar) and caches
+        with this one, but has its own HTTP connections. Used for
+        uploading from several threads.
+        '''
+        # Load the project list before cloning, so that all clones use the
+        # same dictionary
+        if self.project_list_cache is None:
+            self._update_project_list()
+        return self._copy()
+
+    def _copy(self):
+        clone = copy.copy(self)
+        clone.session = clone._new_session()
+        clone.session.headers = self.session.headers.copy()
+        clone.session.cookies = self.session.cookies
+        return clone
+
+    def close_clone(self, clone):
+        '''
+        Takes over the login and catalog state of a clone from clone() or
+        _copy() when it is no longer used, so that it is saved, and closes
+        its HTTP connections.
+        '''
+        self.validated_time = httputils.latest_time(self.validated_time,
+                                                    clone._last_validated())
+        # The lists themselves are shared
+        if clone.fresh_projects:
+            self.fresh_projects = True
+            self.catalog_time = httputils.latest_time(self.catalog_time,
+                                                      clone.catalog_time)
+        clone.session.close()
+
+    def _last_validated(self):
+        # Requests that worked show that the login works, too
+        return httputils.latest_time(self.validated_time,
+                                     self.session.validated_time)
+
+    def _new_session(self):
+        return httputils.new_session(self._is_login_page, self._log_in_again,
+                                     self.login_lock)
 
     def load_session_data(self):
         try:
@@ -96,19 +163,106 @@ class Session:
                 data = pickle.load(f)
                 self.session.cookies.update(data['cookies'])
                 self.device_key = data['device_key']
+                self.validated_time = data.get('validated_time')
         except FileNotFoundError:
             pass
 
     def save_session_data(self):
         with open(SESSION_DATA_FILE, 'wb') as f:
             data = { 'cookies': self.session.cookies,
-                     'device_key': self.device_key }
+                     'device_key': self.device_key,
+                     'validated_time': self._last_validated() }
+            pickle.dump(data, f)
+
+    def load_catalog(self):
+        '''
+        Loads the project and activity lists from the last run, unless
+        they are older than xledger_catalog_max_age.
+        '''
+        try:
+            with open(CATALOG_FILE, 'rb') as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            return
+        max_age = getattr(config, 'xledger_catalog_max_age',
+                          DEFAULT_CATALOG_MAX_AGE)
+        if datetime.datetime.now() - data['time'] > max_age:
+            logger.debug('Catalog cache is too old, ignoring it')
+            return
+        self.catalog_time = data['time']
+        self.project_list_cache = data['projects']
+        self.activity_list_cache = data['activities']
+
+    def save_catalog(self):
+        if not self.fresh_projects and not self.fresh_activities:
+            return
+        with open(CATALOG_FILE, 'wb') as f:
+            data = { 'time': self.catalog_time,
+                     'projects': self.project_list_cache,
+                     'activities': self.activity_list_cache }
             pickle.dump(data, f)
 
+    def refresh_catalog(self):
+        '''
+        Fetches the project list and the activities of all projects.
+        '''
+        self.activity_list_cache = {}
+        self._update_project_list()
+        self._update_activity_lists([(project_id, project_name)
+                                     for project_name, project_id
+                                     in self.project_list_cache.items()])
+
+    def _update_project_list(self):
+        projects = {p['name']: p['id'] for p in self.get_projects()}
+        # Update in place, as clones share the dictionary
+        if self.project_list_cache is None:
+            self.project_list_cache = projects
+        else:
+            self.project_list_cache.clear()
+            self.project_list_cache.update(projects)
+        self.catalog_time = datetime.datetime.now()
+        self.fresh_projects = True
+
+    def _update_activity_list(self, project_id, project_name):
+        self.activity_list_cache[project_id] = {a['name']: a['id']
+                                                for a in
+                                                self.get_activities(project_id,
+                                                                    project_name)}
+        self.fresh_activities.add(project_id)
+
+    def _update_activity_lists(self, projects, jobs=None):
+        '''
+        Like _update_activity_list() for each (project_id, project_name),
+        but several at a time. Each project costs three round trips.
+        '''
+        if jobs is None:
+            jobs = httputils.catalog_jobs()
+        # Not clone(), which would load the project list
+        copies = [self._copy() for _ in range(min(jobs, len(projects)) - 1)]
+        try:
+            activity_lists = httputils.map_concurrently(
+                lambda session, project: session.get_activities(*project),
+                [self] + copies, projects)
+        finally:
+            for session in copies:
+                self.close_clone(session)
+        for (project_id, project_name), activities in zip(projects, activity_lists):
+            self.activity_list_cache[project_id] = {a['name']: a['id']
+                                                    for a in activities}
+            self.fresh_activities.add(project_id)
+
     def is_logged_in(self):
         resp = self.session.get(f"{self.baseurl}/Restricted/Touch.aspx")
         assert resp.status_code == 200
-        return 'Default.aspx' not in resp.url
+        return not self._is_login_page(resp)
+
+    def _is_login_page(self, resp):
+        return 'Default.aspx' in resp.url
+
+    def _log_in_again(self, request_kwargs):
+        self.log_in()
+        self.validated_time = datetime.datetime.now()
+        return request_kwargs
 
     def log_in(self):
         if self.is_logged_in():
@@ -244,74 +398,125 @@ class Session:
 
         sums = timereporting.sum_entries(entries, 'xledger')
 
+        # Mobile reporting page. It is loaded once per day. When a save
+        # returns a new, empty entry form, its state (__EVENTVALIDATION and
+        # the __PBT counter) is used for the next account.
+        frame_url = f'{self.baseurl}/Restricted/TouchFrame.aspx?Mnu=2329&frm=3&src=2&sn=fb_ctl00_pnlButtonsTouch_G&v={java_timestamp}&pk=0&dk={hyphen_date}&pb=true&rf=false'
+        form_fields = None
+
         for account, sum_ in sums.items():
-            project, activity = self._account_to_ids(account)
-            hours = sum_.total_seconds() / 3600
+            try:
+                frame_url, form_fields = self._set_account(date, frame_url,
+                                                           form_fields,
+                                                           account, sum_)
+            except httputils.LoginExpired as e:
+                # The account was not saved, and the form belongs to the
+                # old login. Load the page again.
+                logger.info(f'{e}. Trying again.')
+                frame_url, form_fields = self._set_account(date, frame_url,
+                                                           None,
+                                                           account, sum_)
+
+    def _set_account(self, date, frame_url, form_fields, account, sum_):
+        '''
+        Saves the hours of one account. form_fields is the state of an
+        empty entry form on frame_url, or None to load the page first.
+        Returns (frame_url, form_fields) for the next account.
+        '''
+        hyphen_date = date.strftime("%Y-%m-%d")
 
-            project_id = project[0]
-            project_url_name = project[1].replace(' ', '+')
+        project, activity = self._account_to_ids(account)
+        hours = sum_.total_seconds() / 3600
 
-            activity_id = activity[0]
-            activity_url_name = activity[1].replace(' ', '+')
+        project_id = project[0]
+        project_url_name = project[1].replace(' ', '+')
 
-            # Mobile reporting page
-            resp = self.session.get(f'{self.baseurl}/Restricted/TouchFrame.aspx?Mnu=2329&frm=3&src=2&sn=fb_ctl00_pnlButtonsTouch_G&v={java_timestamp}&pk=0&dk={hyphen_date}&pb=true&rf=false')
+        activity_id = activity[0]
+        activity_url_name = activity[1].replace(' ', '+')
 
+        if form_fields is None:
+            resp = self.session.get(frame_url)
+            frame_url = resp.url
             form_fields = htmlutils.form_fields_from_selector(resp.content, 'form#frmTouchFrame')
 
-            # Set the project
-            common_fields = {
-                "fb$ctl00$txdDAssignment": hyphen_date,
-                "fb$ctl00$ilsRvProject$ilsRvProject_fhp_Txt": project_url_name,
-                "fb$ctl00$ilsRvProject$ilsRvProject_fhp_Txt_S": "*", # Search string used to find project?
-                "fb$ctl00$ilsRvProject$ilsRvProject_fhp_Txt_PK": project_id,
-                **ENTRY_BASE_FIELDS
-                }
-
-            fields_proj = {
-                "__PBT75108-2329-3": form_fields["__PBT75108-2329-3"], # Request counter?
-                "__EVENTVALIDATION": form_fields["__EVENTVALIDATION"],
-                **common_fields
+        # Set the project
+        common_fields = {
+            "fb$ctl00$txdDAssignment": hyphen_date,
+            "fb$ctl00$ilsRvProject$ilsRvProject_fhp_Txt": project_url_name,
+            "fb$ctl00$ilsRvProject$ilsRvProject_fhp_Txt_S": "*", # Search string used to find project?
+            "fb$ctl00$ilsRvProject$ilsRvProject_fhp_Txt_PK": project_id,
+            **ENTRY_BASE_FIELDS
             }
 
-            # We must set the project before we can set an activity
-            # (I guess the __PBT counter tracks the session?)
-            resp = self.session.post(resp.url,
-                                     data=fields_proj)
-            
-            # TODO: Don't use floats, to avoid potential decimal problems
-            hours_str = str(hours).replace('.', ',')
+        fields_proj = {
+            "__PBT75108-2329-3": form_fields["__PBT75108-2329-3"], # Request counter?
+            "__EVENTVALIDATION": form_fields["__EVENTVALIDATION"],
+            **common_fields
+        }
 
-            form_fields = htmlutils.form_fields_from_selector(resp.content, 'form#frmTouchFrame')
+        # We must set the project before we can set an activity
+        # (I guess the __PBT counter tracks the session?)
+        resp = self.session.post(frame_url,
+                                 data=fields_proj)
 
-            # Set the activity and save
-            fields = {
-                "__PBT75108-2329-3": form_fields["__PBT75108-2329-3"], # Request counter?
-                "__EVENTVALIDATION": form_fields["__EVENTVALIDATION"],
-                **common_fields,
-                "fb$ctl00$ilsRvActivity$ilsRvActivity_fhp_Txt": activity_url_name,
-                "fb$ctl00$ilsRvActivity$ilsRvActivity_fhp_Txt_S": "*",
-                "fb$ctl00$ilsRvActivity$ilsRvActivity_fhp_Txt_PK": activity_id,
+        # TODO: Don't use floats, to avoid potential decimal problems
+        hours_str = str(hours).replace('.', ',')
 
-                "fb$ctl00$txfFWorkingHours": hours_str,
+        form_fields = htmlutils.form_fields_from_selector(resp.content, 'form#frmTouchFrame')
 
-                "fb$ctl00$pnlButtons$T": "" # Save button
-            }
+        # Set the activity and save
+        fields = {
+            "__PBT75108-2329-3": form_fields["__PBT75108-2329-3"], # Request counter?
+            "__EVENTVALIDATION": form_fields["__EVENTVALIDATION"],
+            **common_fields,
+            "fb$ctl00$ilsRvActivity$ilsRvActivity_fhp_Txt": activity_url_name,
+            "fb$ctl00$ilsRvActivity$ilsRvActivity_fhp_Txt_S": "*",
+            "fb$ctl00$ilsRvActivity$ilsRvActivity_fhp_Txt_PK": activity_id,
+
+            "fb$ctl00$txfFWorkingHours": hours_str,
 
-            resp = self.session.post(resp.url,
-                                     data=fields)
+            "fb$ctl00$pnlButtons$T": "" # Save button
+        }
+
+        # Save on the page returned when setting the project
+        resp = self.session.post(resp.url,
+                                 data=fields)
 
-            assert resp.status_code == 200
+        assert resp.status_code == 200
 
-            if 'ReturnButtonZoom' not in resp.text:
-                raise Exception(f'Failed to save {project} {activity} for {date}')
+        if 'ReturnButtonZoom' not in resp.text:
+            raise Exception(f'Failed to save {project} {activity} for {date}')
+
+        return frame_url, self._new_entry_form_fields(resp, frame_url)
+
+    def _new_entry_form_fields(self, resp, frame_url):
+        '''
+        Returns the form fields of the response, if it is a new, empty entry
+        form on the same page. Otherwise None, meaning that the page must be
+        loaded again.
+        '''
+        # A different URL, e.g. with the pk of the saved entry, would
+        # edit that entry instead of creating a new one
+        if resp.url != frame_url:
+            return None
+        try:
+            form_fields = htmlutils.form_fields_from_selector(resp.content, 'form#frmTouchFrame')
+        except htmlutils.NoMatchingElement:
+            return None
+        if ("__PBT75108-2329-3" not in form_fields or
+            "__EVENTVALIDATION" not in form_fields or
+            form_fields.get("fb$ctl00$txfFWorkingHours", '') not in ('', '0')):
+            return None
+        return form_fields
 
     def _account_to_ids(self, account):
         project, activity = account
 
-        #if not self.project_list_cache:
-        self.project_list_cache = {p['name']: p['id']
-                                    for p in self.get_projects()}
+        # The cached lists can be out of date, so fetch them again
+        # before giving up
+        if (self.project_list_cache is None or
+            (project not in self.project_list_cache and not self.fresh_projects)):
+            self._update_project_list()
 
         try:
             project_id = self.project_list_cache[project]
@@ -319,13 +524,12 @@ class Session:
         except KeyError:
             raise Exception(f'Could not find project: {project}')
 
-        if project_id not in self.activity_list_cache:
-            self.activity_list_cache[project_id] = {a['name']: a['id']
-                                                    for a in
-                                                    self.get_activities(project_id,
-                                                                        project_name)}
+        activities = self.activity_list_cache.get(project_id)
+        if (activities is None or
+            (activity not in activities and project_id not in self.fresh_activities)):
+            self._update_activity_list(project_id, project_name)
+            activities = self.activity_list_cache[project_id]
 
-        activities = self.activity_list_cache[project_id]
         try:
             activity_id = activities[activity]
             activity_name = activity
@@ -397,7 +601,11 @@ class Session:
         {'id': '1393939',
          'name': 'Activity A'}
         '''
+        # The project is selected in a form of the login
+        return httputils.retry_login_expired(self._get_activities,
+                                             project_id, project_name)
 
+    def _get_activities(self, project_id, project_name):
         url_name = project_name.replace(' ', '+')
 
         java_timestamp = int(datetime.datetime.utcnow().timestamp() * 1000)